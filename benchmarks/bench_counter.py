@@ -0,0 +1,299 @@
+"""Offline benchmarks for the counter cog's hot paths.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_counter --scale quick --save baseline
+    python -m benchmarks.bench_counter --scale quick --compare baseline
+
+Results are written as JSON to benchmarks/results/, comparing against a
+saved run prints the change of every metric and exits with status 1 when
+one of them regressed by more than the tolerance.
+"""
+
+import json
+import platform
+import resource
+import tracemalloc
+from argparse import ArgumentParser
+from asyncio import run, sleep
+from datetime import datetime, timedelta
+from logging import getLogger
+from os import makedirs, path
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+
+from modules.counter import Counter
+from modules.counter.backfill import Backfill
+from modules.counter.export import CSVExport
+from modules.database.sqlite import SQLiteStorage
+
+from .fakes import (
+    FakeBot,
+    FakeChannel,
+    FakeGuild,
+    FakeMessage,
+    FakeUser,
+    MemoryStorage,
+)
+
+RESULTS_DIR = path.join(path.dirname(__file__), "results")
+SCALES = {
+    "quick": {
+        "messages": 50000,
+        "guilds": 50,
+        "users": 10000,
+        "history": 20000,
+        "channels": 10,
+        "export_rows": 5000,
+    },
+    "full": {
+        "messages": 1000000,
+        "guilds": 50,
+        "users": 200000,
+        "history": 200000,
+        "channels": 20,
+        "export_rows": 100000,
+    },
+}
+# Metrics where a higher value is better, everything else should go down
+HIGHER_IS_BETTER = ("per_s",)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def build_guilds(bot, scale):
+    joined_at = datetime.utcnow() - timedelta(days=100)
+    user_ids = range(10**6, 10**6 + scale["users"])
+    for index in range(scale["guilds"]):
+        guild = FakeGuild(
+            1000 + index,
+            user_ids[index :: scale["guilds"]],
+            joined_at=joined_at,
+            cache_members=bot.config.member_cache == "full",
+            rest_latency=bot.rest_latency,
+        )
+        bot.add_guild(guild)
+    bot.config.counted_guilds = [guild.id for guild in bot.guilds]
+    return bot.guilds
+
+
+def message_stream(guilds, scale, rng, chunk_size=10000):
+    """Yields chunks of messages, the gateway makes a new author object for each."""
+    authors = [(guild, user_id) for guild in guilds for user_id in guild.member_ids]
+    bots = FakeUser(2, guilds[0], bot=True)
+    channels = {
+        guild.id: FakeChannel(guild.id * 100 + 99, guild, [], first_id=1)
+        for guild in guilds
+    }
+    for first in range(0, scale["messages"], chunk_size):
+        chunk = []
+        for index in range(first, min(first + chunk_size, scale["messages"])):
+            choice = rng.randrange(len(authors) * 2 + 1)
+            if choice == len(authors) * 2:
+                chunk.append(
+                    FakeMessage(
+                        index, bots, guilds[0], "beep boop beep", channels[guilds[0].id]
+                    )
+                )
+                continue
+            guild, user_id = authors[choice // 2]
+            content = "hi" if choice % 2 else "hello there general kenobi"
+            chunk.append(
+                FakeMessage(
+                    index, guild.author(user_id), guild, content, channels[guild.id]
+                )
+            )
+        yield chunk
+
+
+async def bench_on_message(cog, guilds, scale, rng):
+    elapsed = 0.0
+    for chunk in message_stream(guilds, scale, rng):
+        started = perf_counter()
+        for index, message in enumerate(chunk):
+            await cog.on_message(message)
+            if not index % 1000:
+                # Let early flushes run like they would between gateway events
+                await sleep(0)
+        elapsed += perf_counter() - started
+    return {
+        "messages_per_s": round(scale["messages"] / elapsed),
+        "pending_rows": cog.message_count.rows,
+        "pending_kib": round(cog.message_count.footprint() / 1024, 1),
+    }
+
+
+async def bench_flush(cog, bot):
+    rows = cog.message_count.rows
+    started = perf_counter()
+    await cog.flush()
+    elapsed = perf_counter() - started
+    return {"flush_s": round(elapsed, 4), "flushed_rows": rows}
+
+
+async def bench_backfill(cog, bot, guild, scale, rng):
+    per_channel = scale["history"] // scale["channels"]
+    member_ids = sorted(guild.member_ids)
+    guild.text_channels = [
+        FakeChannel(
+            guild.id * 100 + index,
+            guild,
+            [rng.choice(member_ids) for _ in range(per_channel)],
+            first_id=10**7 * (index + 1),
+            rest_latency=bot.rest_latency,
+        )
+        for index in range(scale["channels"])
+    ]
+    progress_message = await guild.text_channels[0].send("Analyzing messages.")
+    started = perf_counter()
+    backfill = await Backfill.start(cog, guild, guild.text_channels, progress_message)
+    await (await cog.start_backfill(backfill))
+    elapsed = perf_counter() - started
+    # The level roles of the whole guild are queued when a backfill finishes
+    await cog.roles.join()
+    return {
+        "backfill_s": round(elapsed, 3),
+        "backfill_messages_per_s": round(backfill.scanned / elapsed),
+        "role_drain_s": round(perf_counter() - started - elapsed, 3),
+    }
+
+
+async def bench_export(cog, bot, guild, scale):
+    # A tenth of the exported users have left the guild
+    await bot.db.storage.upsert_counts(
+        [
+            (guild.id, 5 * 10**6 + user_id, user_id)
+            for user_id in range(scale["export_rows"])
+        ]
+    )
+    for user_id in range(scale["export_rows"]):
+        if user_id % 10:
+            guild.add_member(5 * 10**6 + user_id, joined_at=datetime.utcnow())
+    started = perf_counter()
+    parts = await CSVExport(cog, guild).run()
+    elapsed = perf_counter() - started
+    size = sum(part.seek(0, 2) for part in parts)
+    for part in parts:
+        part.close()
+    return {
+        "export_s": round(elapsed, 3),
+        "export_rows_per_s": round(scale["export_rows"] / elapsed),
+        "export_kib": round(size / 1024, 1),
+    }
+
+
+async def bench_drain(cog, bot, guilds, scale, rng):
+    for message in next(message_stream(guilds, scale, rng)):
+        await cog.on_message(message)
+    rows = cog.message_count.rows
+    await cog.roles.join()
+    started = perf_counter()
+    cog.cog_unload()
+    await bot.tasks.join("drain")
+    return {
+        "drain_s": round(perf_counter() - started, 4),
+        "drained_rows": rows - cog.message_count.rows,
+    }
+
+
+async def run_benchmarks(args):
+    scale = SCALES[args.scale]
+    rng = Random(args.seed)
+    if args.storage == "sqlite":
+        storage = SQLiteStorage(path.join(mkdtemp(), "bench.db"), getLogger())
+    else:
+        storage = MemoryStorage(args.db_latency)
+    await storage.connect()
+    bot = FakeBot(storage, rest_latency=args.rest_latency)
+    bot.config.member_cache = args.member_cache
+    guilds = build_guilds(bot, scale)
+    cog = Counter(bot)
+    # Let wait_for_db load the settings and start the flush loop
+    await sleep(0.01)
+    results = {}
+
+    async def _measure(name, coro):
+        if args.trace_memory:
+            tracemalloc.start()
+        results[name] = await coro
+        if args.trace_memory:
+            results[name]["traced_peak_kib"] = round(
+                tracemalloc.get_traced_memory()[1] / 1024, 1
+            )
+            tracemalloc.stop()
+        results[name]["peak_rss_mb"] = peak_rss_mb()
+        print(f"{name}: {results[name]}")
+
+    await _measure("on_message", bench_on_message(cog, guilds, scale, rng))
+    await _measure("flush", bench_flush(cog, bot))
+    await _measure("backfill", bench_backfill(cog, bot, guilds[0], scale, rng))
+    await _measure("export", bench_export(cog, bot, guilds[1], scale))
+    await _measure("drain", bench_drain(cog, bot, guilds, scale, rng))
+    await storage.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = 0
+    for scenario, metrics in results.items():
+        for name, value in metrics.items():
+            old = baseline.get(scenario, {}).get(name)
+            if not old or not isinstance(value, (int, float)):
+                continue
+            change = (value - old) / old
+            worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  <-- regression"
+                regressions += 1
+            print(f"{scenario}.{name}: {old} -> {value} ({change:+.1%}){flag}")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="quick")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--member-cache", choices=("full", "low"), default="full")
+    parser.add_argument("--db-latency", type=float, default=0.0005)
+    parser.add_argument("--rest-latency", type=float, default=0.005)
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--save", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = run(run_benchmarks(args))
+    if args.save:
+        makedirs(RESULTS_DIR, exist_ok=True)
+        with open(path.join(RESULTS_DIR, f"{args.save}.json"), "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "scale": args.scale,
+                        "storage": args.storage,
+                        "member_cache": args.member_cache,
+                        "python": platform.python_version(),
+                        "created_at": datetime.utcnow().isoformat(),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        with open(path.join(RESULTS_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["scale"] != args.scale:
+            print(f"Warning: the baseline was run at {baseline['meta']['scale']} scale")
+        if compare(results, baseline["results"], args.tolerance):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
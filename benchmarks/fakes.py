@@ -0,0 +1,381 @@
+"""Stand-ins for the gateway objects and the storage used by the counter.
+
+They implement just enough of discord.py and the storage interface for the
+counter cog to run without a Discord connection or a database server.
+Database round trips and REST calls can be given an artificial latency.
+"""
+
+import logging
+from asyncio import get_running_loop, sleep
+
+from discord.utils import SnowflakeList
+
+from loader import ModuleLoader
+from logs import ErrorLog
+from modules.database.storage import Storage
+from modules.metrics import Registry
+from supervisor import TaskSupervisor
+
+
+class MemoryStorage(Storage):
+    """Keeps everything in dicts, every call costs one simulated round trip."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self.counts = {}
+        self.backfills = {}
+        self.checkpoints = {}
+        self.settings = {}
+        self.activity = {}
+        self.profiles = {}
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            await sleep(self.latency)
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def upsert_counts(self, rows, hour=None):
+        await self._round_trip()
+        results = []
+        for guild_id, user_id, count in rows:
+            key = (guild_id, user_id)
+            self.counts[key] = self.counts.get(key, 0) + count
+            results.append((guild_id, user_id, self.counts[key]))
+            if hour:
+                key = (guild_id, user_id, hour)
+                self.activity[key] = self.activity.get(key, 0) + count
+        return results
+
+    async def recent_activity(self, guild_id, since):
+        await self._round_trip()
+        activity = {}
+        for (row_guild_id, user_id, hour), messages in self.activity.items():
+            if row_guild_id == guild_id and hour >= since:
+                activity[user_id] = activity.get(user_id, 0) + messages
+        return activity
+
+    async def user_activity(self, guild_id, user_id, since):
+        return (await self.recent_activity(guild_id, since)).get(user_id, 0)
+
+    async def rollup_activity(self, now, hourly_days, retention_days):
+        # Hours are kept as they are, nothing here reads old enough windows
+        await self._round_trip()
+
+    async def ping(self):
+        await self._round_trip()
+
+    async def get_count(self, guild_id, user_id):
+        await self._round_trip()
+        return self.counts.get((guild_id, user_id))
+
+    async def iter_guild(self, guild_id, replica=False):
+        await self._round_trip()
+        rows = [
+            (user_id, count)
+            for (row_guild_id, user_id), count in self.counts.items()
+            if row_guild_id == guild_id
+        ]
+        for i in range(0, len(rows), 1000):
+            await self._round_trip()
+            for row in rows[i : i + 1000]:
+                yield row
+
+    async def top_counts(self, guild_id, limit, offset=0):
+        rows = [row async for row in self.iter_guild(guild_id)]
+        rows.sort(key=lambda row: (-row[1], row[0]))
+        return rows[offset : offset + limit]
+
+    async def start_backfill(
+        self, guild_id, boundary_id, channel_id, message_id, channel_ids
+    ):
+        await self._round_trip()
+        for key in [key for key in self.counts if key[0] == guild_id]:
+            del self.counts[key]
+        self.backfills[guild_id] = (guild_id, boundary_id, channel_id, message_id)
+        self.checkpoints[guild_id] = {
+            channel_id: (None, False) for channel_id in channel_ids
+        }
+
+    async def get_backfill(self, guild_id):
+        await self._round_trip()
+        backfill = self.backfills.get(guild_id)
+        return backfill[1] if backfill else None
+
+    async def list_backfills(self):
+        await self._round_trip()
+        return list(self.backfills.values())
+
+    async def backfill_checkpoints(self, guild_id):
+        await self._round_trip()
+        checkpoints = self.checkpoints.get(guild_id, {})
+        return len(checkpoints), [
+            (channel_id, last_message_id)
+            for channel_id, (last_message_id, done) in checkpoints.items()
+            if not done
+        ]
+
+    async def save_checkpoint(self, guild_id, channel_id, last_message_id, done, rows):
+        await self.upsert_counts(rows)
+        self.checkpoints[guild_id][channel_id] = (last_message_id, done)
+
+    async def finish_backfill(self, guild_id):
+        await self._round_trip()
+        self.backfills.pop(guild_id, None)
+        self.checkpoints.pop(guild_id, None)
+
+    async def list_guild_settings(self):
+        await self._round_trip()
+        return list(self.settings.values())
+
+    async def get_guild_settings(self, guild_id):
+        await self._round_trip()
+        return self.settings.get(guild_id)
+
+    async def save_guild_settings(
+        self, guild_id, enabled, min_words, excluded_channels, level_rules
+    ):
+        await self._round_trip()
+        self.settings[guild_id] = (
+            guild_id,
+            enabled,
+            min_words,
+            list(excluded_channels),
+            level_rules,
+        )
+
+    async def save_profiles(self, profiles, renames):
+        await self._round_trip()
+        for guild_id, user_id, name, is_member, refreshed_at in profiles:
+            self.profiles[guild_id, user_id] = (name, is_member, refreshed_at)
+        for user_id, name, refreshed_at in renames:
+            for (guild_id, row_user_id), profile in list(self.profiles.items()):
+                if row_user_id == user_id:
+                    self.profiles[guild_id, user_id] = (name, profile[1], refreshed_at)
+
+    async def get_profiles(self, guild_id, user_ids):
+        await self._round_trip()
+        return [
+            (user_id, *self.profiles[guild_id, user_id])
+            for user_id in user_ids
+            if (guild_id, user_id) in self.profiles
+        ]
+
+    async def stale_profiles(self, before, limit, guild_ids):
+        await self._round_trip()
+        guild_ids = set(guild_ids)
+        stale = sorted(
+            (refreshed_at, user_id)
+            for (guild_id, user_id), (_, _, refreshed_at) in self.profiles.items()
+            if refreshed_at < before and guild_id in guild_ids
+        )
+        return list(dict.fromkeys(user_id for _, user_id in stale[:limit]))
+
+
+class FakeDatabase:
+    def __init__(self, storage):
+        self.storage = storage
+        self.is_ready = True
+
+
+class FakeRole:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class FakeUser:
+    __slots__ = ("id", "bot", "name", "guild", "joined_at", "_roles")
+
+    def __init__(self, id, guild=None, bot=False, joined_at=None):
+        self.id = id
+        self.bot = bot
+        self.name = f"user{id}"
+        self.guild = guild
+        self.joined_at = joined_at
+        self._roles = SnowflakeList([])
+
+    def __str__(self):
+        return f"{self.name}#0001"
+
+    @property
+    def roles(self):
+        return [role for role in self.guild.roles if self._roles.has(role.id)]
+
+    async def add_roles(self, *roles, reason=None):
+        for role in roles:
+            self._roles.add(role.id)
+
+    async def remove_roles(self, *roles, reason=None):
+        for role in roles:
+            self._roles.remove(role.id)
+
+    async def edit(self, roles, reason=None):
+        self._roles = SnowflakeList([role.id for role in roles])
+
+
+class FakeMessage:
+    __slots__ = ("id", "author", "guild", "channel", "content")
+
+    def __init__(self, id, author, guild, content, channel=None):
+        self.id = id
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+class FakeChannel:
+    """A text channel whose history is generated from a list of author ids."""
+
+    def __init__(self, id, guild, authors, first_id, rest_latency=0.0):
+        self.id = id
+        self.name = f"channel-{id}"
+        self.guild = guild
+        self.authors = authors
+        self.first_id = first_id
+        self.rest_latency = rest_latency
+
+    async def send(self, content=None, **kwargs):
+        return FakeMessage(self.first_id - 1, self.guild.me, self.guild, content, self)
+
+    def message(self, index):
+        author = self.guild.author(self.authors[index])
+        content = "just a short" if index % 5 else "hi"
+        return FakeMessage(self.first_id + index, author, self.guild, content, self)
+
+    async def history(self, limit=None, after=None, before=None, oldest_first=None):
+        start = 0 if not after else max(after.id - self.first_id + 1, 0)
+        end = len(self.authors)
+        if before:
+            end = min(end, before.id - self.first_id)
+        # Discord serves history in pages of 100 messages
+        for page in range(start, end, 100):
+            await sleep(self.rest_latency)
+            for index in range(page, min(page + 100, end)):
+                yield self.message(index)
+
+
+class FakeGuild:
+    """A guild whose member cache is either complete or empty.
+
+    Members that aren't cached are made up when they send a message or are
+    requested, like the gateway sends them along.
+    """
+
+    def __init__(
+        self,
+        id,
+        member_ids,
+        joined_at,
+        cache_members=True,
+        rest_latency=0.0,
+        filesize_limit=8 * 1024 * 1024,
+    ):
+        self.id = id
+        self.name = f"guild{id}"
+        self.filesize_limit = filesize_limit
+        self.roles = [
+            FakeRole(id * 10 + level, f"Level {level}") for level in (1, 2, 3)
+        ]
+        self.owner_id = id
+        self.me = FakeUser(1, self, bot=True)
+        self.joined_at = joined_at
+        self.cache_members = cache_members
+        self.rest_latency = rest_latency
+        self.member_ids = set()
+        self.members = {}
+        self.text_channels = []
+        for user_id in member_ids:
+            self.add_member(user_id)
+
+    def add_member(self, user_id, joined_at=None):
+        self.member_ids.add(user_id)
+        if self.cache_members:
+            self.members[user_id] = FakeUser(
+                user_id, self, joined_at=joined_at or self.joined_at
+            )
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def author(self, user_id):
+        return self.members.get(user_id) or FakeUser(
+            user_id, self, joined_at=self.joined_at
+        )
+
+    async def query_members(self, *, user_ids, limit, cache):
+        await sleep(self.rest_latency)
+        return [
+            FakeUser(user_id, self, joined_at=self.joined_at)
+            for user_id in user_ids
+            if user_id in self.member_ids
+        ]
+
+    def get_channel(self, channel_id):
+        for channel in self.text_channels:
+            if channel.id == channel_id:
+                return channel
+
+
+class FakeConfig:
+    prefix = "."
+    member_cache = "full"
+    counted_guilds = []
+    flush_interval = 3600.0
+    init_progress_interval = 3600.0
+
+
+class FakeBot:
+    """The parts of commands.Bot the counter cog uses."""
+
+    def __init__(self, storage, rest_latency=0.0):
+        self.loop = get_running_loop()
+        self.logger = logging.getLogger("benchmark")
+        self.config = FakeConfig()
+        self.metrics = Registry()
+        self.errors = ErrorLog(self.logger)
+        self.db = FakeDatabase(storage)
+        self.loader = ModuleLoader(self)
+        self.loader.set_ready("database")
+        self.tasks = TaskSupervisor(self)
+        self._guilds = {}
+        self.rest_latency = rest_latency
+
+    @property
+    def guilds(self):
+        return list(self._guilds.values())
+
+    def add_guild(self, guild):
+        self._guilds[guild.id] = guild
+
+    def get_guild(self, guild_id):
+        return self._guilds.get(guild_id)
+
+    def get_user(self, user_id):
+        # No user cache, every lookup goes through fetch_user
+        return None
+
+    async def wait_until_ready(self):
+        pass
+
+    async def fetch_user(self, user_id):
+        await sleep(self.rest_latency)
+        return FakeUser(user_id)
+
+    def unload_extension(self, name):
+        pass
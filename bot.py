@@ -1,45 +1,109 @@
 import logging
-from traceback import print_exc
+import sys
+from asyncio import TimeoutError, gather, wait_for
+from time import perf_counter
 
 import discord
 from discord.ext import commands
 
 import config
+from loader import ModuleLoader
+from logs import ErrorLog, setup_logging
+from modules.metrics import Registry
+from supervisor import TaskSupervisor
 
-intents = discord.Intents.default()
-intents.members = True
-bot = commands.Bot(
-    command_prefix=commands.when_mentioned_or(config.prefix),
-    owner_id=810196248652546118,
-    intents=intents,
-)
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
-)
+log_handler = setup_logging()
 dpy_logger = logging.getLogger("discord")
 dpy_logger.setLevel(logging.ERROR)
 
 
-@bot.event
-async def on_ready():
-    print(f"{bot.user} | {len(bot.guilds)} guilds | {len(bot.users)} users seen")
+def create_bot(bot_class=commands.Bot, **options):
+    """Creates the bot, launcher.py passes AutoShardedBot and its shards."""
+    intents = discord.Intents.default()
+    intents.members = True
+    if getattr(config, "member_cache", "full") == "low":
+        # Members are requested when needed, the counter keeps recent authors
+        options.update(
+            member_cache_flags=discord.MemberCacheFlags.none(),
+            chunk_guilds_at_startup=False,
+        )
+    bot = bot_class(
+        command_prefix=commands.when_mentioned_or(config.prefix),
+        owner_id=810196248652546118,
+        intents=intents,
+        **options,
+    )
+    bot.metrics = Registry()
+    bot.logger = logging.getLogger()
+    bot.errors = ErrorLog(
+        bot.logger,
+        getattr(config, "error_log_size", 200),
+        getattr(config, "error_log_interval", 60.0),
+    )
+    bot.metrics.gauge(
+        "postnrole_log_records_dropped",
+        "Log records dropped while the logging queue was full",
+        lambda: log_handler.dropped,
+    )
+    bot.config = config
+    bot.loader = ModuleLoader(bot)
+    bot.tasks = TaskSupervisor(bot, getattr(config, "task_limits", None))
+    # Set by launcher.py when running as one process of a cluster
+    bot.cluster = None
+
+    @bot.event
+    async def on_ready():
+        print(
+            f"{bot.user} | {len(bot.guilds)} guilds | {len(bot.users)} users seen"
+            f" | ready after {perf_counter() - bot.loader.started:.2f}s"
+        )
+
+    close = bot.close
+
+    async def drain_and_close():
+        """Unloads the modules while the loop still runs, so they can drain."""
+        started = perf_counter()
+        # Dependents first, the database closes after what needs it drained
+        for extension in reversed(tuple(bot.extensions)):
+            try:
+                bot.unload_extension(extension)
+            except Exception:
+                bot.logger.exception(f"Couldn't unload {extension}.")
+        try:
+            await wait_for(
+                gather(bot.tasks.join("drain"), bot.tasks.join("shutdown")),
+                getattr(config, "shutdown_deadline", 10.0) + 5.0,
+            )
+        except TimeoutError:
+            bot.logger.warning("Shutting down before every module drained.")
+        bot.logger.info(f"Shut down the modules in {perf_counter() - started:.3f}s.")
+        await close()
+
+    # Also what bot.run calls on SIGINT and SIGTERM
+    bot.close = drain_and_close
 
+    @bot.event
+    async def on_error(event, *args, **kwargs):
+        bot.errors.report(f"event {event}", sys.exc_info()[1])
 
-@commands.is_owner()
-@bot.command(hidden=True)
-async def poweroff(ctx):
-    """Turns off the bot"""
-    await ctx.send("Bye...")
-    await bot.close()
+    @commands.is_owner()
+    @bot.command(hidden=True)
+    async def poweroff(ctx):
+        """Turns off the bot"""
+        await ctx.send("Bye...")
+        if bot.cluster:
+            bot.cluster.send("poweroff")
+        else:
+            await bot.close()
+
+    return bot
+
+
+def load_modules(bot):
+    bot.loader.load_all(config.modules)
 
 
 if __name__ == "__main__":
-    bot.logger = logging.getLogger()
-    for module in config.modules:
-        try:
-            bot.load_extension(f"modules.{module}")
-        except:
-            bot.logger.error(f"Couldn't load module: {module}")
-            print_exc()
-    bot.config = config
+    bot = create_bot()
+    load_modules(bot)
     bot.run(config.token)
@@ -0,0 +1,248 @@
+"""Runs the bot as a cluster of processes, each one an AutoShardedBot over
+its own range of shards, so gateway events are handled on several cores.
+
+    python launcher.py
+
+The launcher starts the processes one at a time (a process has to become
+ready before the next one identifies), restarts processes that exit and
+relays owner commands such as poweroff and reload to every process.
+"""
+
+import logging
+import multiprocessing
+import signal
+from asyncio import run
+from multiprocessing.connection import wait
+from os import path
+from threading import Thread
+from time import monotonic
+
+import config
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s [%(processName)s] %(message)s"
+)
+logger = logging.getLogger("launcher")
+
+# Seconds a process gets to become ready before the next one is started anyway
+READY_TIMEOUT = 120.0
+# A process that ran this long before exiting restarts without delay
+HEALTHY_UPTIME = 300.0
+MAX_RESTART_DELAY = 60.0
+
+
+class ClusterLink:
+    """A process' end of its pipe to the launcher.
+
+    Messages are tuples, the launcher relays everything but "ready" to
+    every process of the cluster, including the one that sent it.
+    """
+
+    def __init__(self, bot, cluster_id, conn):
+        self.bot = bot
+        self.cluster_id = cluster_id
+        self.conn = conn
+        bot.add_listener(self.on_ready)
+        # A daemon thread, so a blocked recv never holds up the exit
+        Thread(target=self.listen, name="cluster-link", daemon=True).start()
+
+    def send(self, *message):
+        self.conn.send(message)
+
+    async def on_ready(self):
+        self.send("ready")
+
+    def listen(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                # The launcher is gone
+                message = ("poweroff",)
+            self.bot.loop.call_soon_threadsafe(self.handle, *message)
+            if message[0] == "poweroff":
+                return
+
+    def handle(self, action, *args):
+        if action == "poweroff":
+            # Not in "shutdown", close() waits for that group to finish
+            self.bot.tasks.spawn("poweroff", self.bot.close())
+        elif action == "extension":
+            operation, module = args
+            try:
+                getattr(self.bot, f"{operation}_extension")(f"modules.{module}")
+            except Exception as e:
+                self.bot.logger.error(
+                    f"Couldn't {operation} module {module}: {type(e).__name__} - {e}"
+                )
+            else:
+                self.bot.logger.info(f"{operation.capitalize()}ed module {module}.")
+        else:
+            # e.g. ("settings", guild_id) reaches on_cluster_settings(guild_id)
+            self.bot.dispatch(f"cluster_{action}", *args)
+
+
+def run_cluster(cluster_id, shard_ids, shard_count, conn):
+    from discord.ext import commands
+
+    from bot import create_bot, load_modules
+
+    # Resources that can't be shared between processes get one per cluster
+    if getattr(config, "journal_path", None):
+        config.journal_path = path.join(config.journal_path, f"cluster-{cluster_id}")
+    if getattr(config, "metrics_port", None):
+        config.metrics_port += cluster_id
+    bot = create_bot(
+        commands.AutoShardedBot, shard_ids=shard_ids, shard_count=shard_count
+    )
+    bot.cluster = ClusterLink(bot, cluster_id, conn)
+    load_modules(bot)
+    bot.run(config.token)
+
+
+async def recommended_shards():
+    from discord.http import HTTPClient
+
+    http = HTTPClient()
+    try:
+        await http.static_login(config.token, bot=True)
+        shards, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards
+
+
+class Cluster:
+    __slots__ = ("id", "shard_ids", "process", "conn", "started_at", "restarts")
+
+    def __init__(self, id, shard_ids):
+        self.id = id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.conn = None
+        self.started_at = None
+        self.restarts = 0
+
+
+class Launcher:
+    def __init__(self, processes, shard_count):
+        self.shard_count = shard_count
+        per_process = -(-shard_count // processes)
+        self.clusters = [
+            Cluster(index, list(range(first, min(first + per_process, shard_count))))
+            for index, first in enumerate(range(0, shard_count, per_process))
+        ]
+        # (start after, cluster) in the order they'll be started
+        self.queue = [(0.0, cluster) for cluster in self.clusters]
+        self.starting = None
+        self.stopping = False
+        # Workers are fresh interpreters, nothing of the launcher is inherited
+        self.context = multiprocessing.get_context("spawn")
+
+    def start(self, cluster):
+        conn, child_conn = self.context.Pipe()
+        cluster.process = self.context.Process(
+            target=run_cluster,
+            args=(cluster.id, cluster.shard_ids, self.shard_count, child_conn),
+            name=f"cluster-{cluster.id}",
+        )
+        cluster.process.start()
+        child_conn.close()
+        cluster.conn = conn
+        cluster.started_at = monotonic()
+        self.starting = cluster
+        logger.info(
+            f"Started cluster {cluster.id} with shards {cluster.shard_ids[0]}-{cluster.shard_ids[-1]}."
+        )
+
+    def broadcast(self, message):
+        for cluster in self.clusters:
+            if cluster.conn:
+                try:
+                    cluster.conn.send(message)
+                except OSError:
+                    pass
+
+    def stop(self, *args):
+        if not self.stopping:
+            logger.info("Shutting down the cluster.")
+            self.stopping = True
+            self.queue.clear()
+            self.broadcast(("poweroff",))
+
+    def on_message(self, cluster, message):
+        if message[0] == "ready":
+            logger.info(f"Cluster {cluster.id} is ready.")
+            if self.starting is cluster:
+                self.starting = None
+        elif message[0] == "poweroff":
+            self.stop()
+        else:
+            self.broadcast(message)
+
+    def on_exit(self, cluster):
+        cluster.conn.close()
+        cluster.conn = None
+        exitcode = cluster.process.exitcode
+        cluster.process = None
+        if self.starting is cluster:
+            self.starting = None
+        if self.stopping:
+            return
+        if monotonic() - cluster.started_at > HEALTHY_UPTIME:
+            cluster.restarts = 0
+        delay = min(2**cluster.restarts - 1, MAX_RESTART_DELAY)
+        cluster.restarts += 1
+        logger.warning(
+            f"Cluster {cluster.id} exited with code {exitcode}, restarting in {delay}s."
+        )
+        self.queue.append((monotonic() + delay, cluster))
+
+    def next_start(self):
+        """Starts the next queued cluster when it's due, returns the wait until then."""
+        if not self.queue:
+            return None
+        if self.starting:
+            if monotonic() - self.starting.started_at < READY_TIMEOUT:
+                return self.starting.started_at + READY_TIMEOUT - monotonic()
+            logger.warning(f"Cluster {self.starting.id} didn't become ready in time.")
+            self.starting = None
+        start_after, cluster = self.queue[0]
+        if start_after > monotonic():
+            return start_after - monotonic()
+        self.queue.pop(0)
+        self.start(cluster)
+        return 0.0
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        while True:
+            timeout = self.next_start()
+            running = {
+                cluster.conn: cluster for cluster in self.clusters if cluster.conn
+            }
+            if not running and not self.queue:
+                break
+            sentinels = {
+                cluster.process.sentinel: cluster for cluster in running.values()
+            }
+            for ready in wait([*running, *sentinels], timeout):
+                if ready in running:
+                    try:
+                        message = ready.recv()
+                    except (EOFError, OSError):
+                        # Its sentinel reports the exit
+                        continue
+                    self.on_message(running[ready], message)
+                elif sentinels[ready].conn:
+                    sentinels[ready].process.join()
+                    self.on_exit(sentinels[ready])
+        logger.info("All clusters have exited.")
+
+
+if __name__ == "__main__":
+    shard_count = getattr(config, "shard_count", None) or run(recommended_shards())
+    processes = min(getattr(config, "cluster_processes", 2), shard_count)
+    logger.info(f"Running {shard_count} shards in {processes} processes.")
+    Launcher(processes, shard_count).run()
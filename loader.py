@@ -0,0 +1,159 @@
+"""Loads the modules in dependency order and tracks when they're ready.
+
+A module declares what it needs in its package:
+
+    # Loaded after these modules, see loader.py
+    DEPENDENCIES = ("database",)
+    # Calls bot.loader.set_ready("counter") itself once it's usable
+    SIGNALS_READY = True
+
+Both are read from the source without importing it, discord.py would
+execute the module a second time when loading it. Modules without
+SIGNALS_READY are ready as soon as their setup returned. A module waits
+for another one with `await bot.loader.wait_ready(name)` instead of
+polling it.
+"""
+
+import ast
+import importlib.util
+from asyncio import Event
+from time import perf_counter
+
+
+def read_declarations(name):
+    """Returns the DEPENDENCIES and SIGNALS_READY of modules.<name>."""
+    spec = importlib.util.find_spec(f"modules.{name}")
+    if spec is None:
+        return (), False
+    declarations = {"DEPENDENCIES": (), "SIGNALS_READY": False}
+    for node in ast.parse(spec.loader.get_source(spec.name)).body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1:
+            target = node.targets[0]
+            if isinstance(target, ast.Name) and target.id in declarations:
+                declarations[target.id] = ast.literal_eval(node.value)
+    return tuple(declarations["DEPENDENCIES"]), declarations["SIGNALS_READY"]
+
+
+class ModuleLoader:
+    def __init__(self, bot):
+        self.bot = bot
+        self.started = perf_counter()
+        # name -> seconds its setup took
+        self.load_times = {}
+        # name -> seconds from the start until it was ready
+        self.ready_times = {}
+        self.failed = set()
+        self.pending = set()
+        # name -> state an unloaded module left for its next instance
+        self.handoffs = {}
+        self._events = {}
+        self._declarations = {}
+
+    def declarations(self, name):
+        declarations = self._declarations.get(name)
+        if declarations is None:
+            declarations = self._declarations[name] = read_declarations(name)
+        return declarations
+
+    def _event(self, name):
+        event = self._events.get(name)
+        if event is None:
+            event = self._events[name] = Event()
+        return event
+
+    def order(self, names):
+        """Sorts the modules so every one comes after its dependencies.
+
+        Keeps the given order where the dependencies allow it. Modules with
+        a dependency that isn't in names or that are part of a cycle are
+        left out.
+        """
+        dependencies = {name: self.declarations(name)[0] for name in names}
+        ordered = []
+        remaining = list(names)
+        while remaining:
+            for name in remaining:
+                if all(dependency in ordered for dependency in dependencies[name]):
+                    ordered.append(name)
+                    remaining.remove(name)
+                    break
+            else:
+                for name in remaining:
+                    missing = [
+                        dependency
+                        for dependency in dependencies[name]
+                        if dependency not in ordered
+                    ]
+                    self.bot.logger.error(
+                        f"Couldn't load module {name}, it depends on {', '.join(missing)}."
+                    )
+                    self.set_failed(name)
+                break
+        return ordered
+
+    def load_all(self, names):
+        for name in self.order(names):
+            if any(
+                dependency in self.failed for dependency in self.declarations(name)[0]
+            ):
+                self.bot.logger.error(
+                    f"Couldn't load module {name}, a dependency failed to load."
+                )
+                self.set_failed(name)
+                continue
+            self.load(name)
+
+    def load(self, name):
+        signals_ready = self.declarations(name)[1]
+        self.reset(name)
+        if signals_ready:
+            self.pending.add(name)
+        started = perf_counter()
+        try:
+            self.bot.load_extension(f"modules.{name}")
+        except:
+            self.bot.logger.exception(f"Couldn't load module: {name}")
+            return self.set_failed(name)
+        self.load_times[name] = perf_counter() - started
+        if not signals_ready:
+            self.set_ready(name)
+
+    def reset(self, name):
+        """Forgets the module's state, e.g. before it's loaded again."""
+        self._declarations.pop(name, None)
+        self._event(name).clear()
+        self.failed.discard(name)
+        self.ready_times.pop(name, None)
+
+    def set_ready(self, name):
+        self.ready_times[name] = perf_counter() - self.started
+        self._event(name).set()
+        self._settle(name)
+
+    def set_failed(self, name):
+        """Marks a module that won't become ready, its dependents stop waiting."""
+        self.failed.add(name)
+        self._event(name).set()
+        self._settle(name)
+
+    def _settle(self, name):
+        if name not in self.pending:
+            return
+        self.pending.discard(name)
+        if not self.pending:
+            self.bot.logger.info(
+                f"All modules are ready after {perf_counter() - self.started:.2f}s."
+            )
+
+    def hand_off(self, name, state):
+        """Keeps state for the module's next instance, e.g. across a reload."""
+        self.handoffs[name] = state
+
+    def take_handoff(self, name):
+        """Returns and forgets the state the previous instance left, or None."""
+        return self.handoffs.pop(name, None)
+
+    async def wait_ready(self, name):
+        """Waits until the module is ready, returns False if it failed instead."""
+        await self._event(name).wait()
+        return name not in self.failed
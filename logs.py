@@ -0,0 +1,153 @@
+"""Logging that doesn't block the event loop, and errors grouped by cause.
+
+setup_logging() moves the root logger's handlers behind a queue that a
+listener thread drains, so a slow terminal or log file never holds up
+the gateway. ErrorLog keeps one entry per fingerprint (where the error
+happened, its type and the frame it was raised in) and logs the
+traceback of a recurring error only once per interval.
+"""
+
+import atexit
+import logging
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from time import monotonic, time
+from traceback import extract_tb, format_exception
+
+# Records waiting for the listener thread before new ones are dropped
+QUEUE_SIZE = 10000
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Never blocks the caller, records are dropped while the queue is full."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def setup_logging(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"):
+    """Puts the root logger's handlers behind a queue, returns the queue's handler.
+
+    Handlers that are already installed, e.g. by launcher.py, are kept and
+    run on the listener thread. Without any, one writing to stderr with the
+    given format is created.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            return handler
+    handlers = root.handlers[:]
+    if not handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(format))
+        handlers.append(handler)
+    for handler in handlers:
+        root.removeHandler(handler)
+    queue_handler = DroppingQueueHandler(Queue(QUEUE_SIZE))
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Writes out what's still queued when the process exits
+    atexit.register(listener.stop)
+    return queue_handler
+
+
+class ErrorEntry:
+    __slots__ = (
+        "source",
+        "type",
+        "frame",
+        "message",
+        "count",
+        "first_seen",
+        "last_seen",
+        "logged_at",
+        "suppressed",
+    )
+
+    def __init__(self, source, type, frame):
+        self.source = source
+        self.type = type
+        self.frame = frame
+        self.message = ""
+        self.count = 0
+        self.first_seen = time()
+        self.last_seen = self.first_seen
+        self.logged_at = None
+        # Occurrences since the traceback was last logged
+        self.suppressed = 0
+
+
+def fingerprint(source, error):
+    """Returns (source, exception type, innermost frame) of the error."""
+    frames = extract_tb(error.__traceback__)
+    if frames:
+        frame = frames[-1]
+        location = f"{frame.filename}:{frame.lineno} ({frame.name})"
+    else:
+        location = "unknown"
+    return source, f"{type(error).__module__}.{type(error).__qualname__}", location
+
+
+class ErrorLog:
+    """The most recently seen distinct errors, at most maxsize of them.
+
+    An error that was seen before only bumps its entry's count, its
+    traceback is logged again once log_interval seconds have passed, so a
+    storm of the same failure doesn't flood the log.
+    """
+
+    def __init__(self, logger, maxsize=200, log_interval=60.0):
+        self.logger = logger
+        self.maxsize = maxsize
+        self.log_interval = log_interval
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def report(self, source, error):
+        key = fingerprint(source, error)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = ErrorEntry(*key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+            entry.last_seen = time()
+        entry.count += 1
+        entry.message = str(error)
+        if entry.logged_at and monotonic() - entry.logged_at < self.log_interval:
+            entry.suppressed += 1
+            return entry
+        repeated = (
+            f" (seen {entry.suppressed} more times since it was last logged)"
+            if entry.suppressed
+            else ""
+        )
+        self.logger.error(
+            f"In {source}{repeated}:\n"
+            + "".join(
+                format_exception(type(error), error, error.__traceback__)
+            ).rstrip()
+        )
+        entry.logged_at = monotonic()
+        entry.suppressed = 0
+        return entry
+
+    def top(self, limit=10):
+        """Returns the entries seen most often."""
+        return sorted(self._entries.values(), key=lambda entry: -entry.count)[:limit]
+
+    def clear(self):
+        self._entries.clear()
@@ -1,21 +1,36 @@
-from asyncio import Lock, TimeoutError, sleep
-from csv import DictWriter
-from datetime import datetime
-from io import StringIO
-from time import time
-
-from discord import Embed, File, Member
-from discord.errors import Forbidden, NotFound
+from asyncio import CancelledError, Lock, TimeoutError, wait, wait_for
+from datetime import datetime, timedelta, timezone
+from time import monotonic, perf_counter, time
+
+from discord import Embed, File, Member, TextChannel
+from discord.errors import HTTPException, NotFound
 from discord.ext import commands, tasks
-from discord.utils import get as discord_get
-from pytz import utc
+
+from .backfill import Backfill
+from .buffer import PendingCounts
+from .cache import CountCache
+from .export import CSVExport
+from .journal import Journal
+from .levels import DEFAULT_LEVEL_RULES, LevelRule, LevelTable
+from .members import MemberResolver
+from .profiles import ProfileCache
+from .ranking import GuildRanking
+from .roles import RoleReconciler
+from .settings import SettingsRegistry
+
+LEADERBOARD_PAGE_SIZE = 10
+# Times a count missing from the cache is read while flushes keep overlapping
+READ_ATTEMPTS = 3
+# See loader.py
+DEPENDENCIES = ("database",)
+SIGNALS_READY = True
 
 
 def is_guild_owner():
     def predicate(ctx):
         if not ctx.guild:
             return False
-        return ctx.message.author.id in [ctx.guild.owner.id, ctx.bot.owner_id]
+        return ctx.message.author.id in [ctx.guild.owner_id, ctx.bot.owner_id]
 
     return commands.check(predicate)
 
@@ -23,29 +38,205 @@ def is_guild_owner():
 class Counter(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.message_count = {}
-        self.lock = Lock()
-        bot.loop.create_task(self.wait_for_db())
+        self.pending_limit = getattr(bot.config, "pending_limit", 500000)
+        self.message_count = PendingCounts(self.pending_limit)
+        self.flush_lock = Lock()
+        self.flush_threshold = getattr(bot.config, "flush_threshold", 10000)
+        self.init_concurrency = getattr(bot.config, "init_concurrency", 3)
+        self.init_checkpoint_every = getattr(bot.config, "init_checkpoint_every", 1000)
+        self.init_progress_interval = getattr(bot.config, "init_progress_interval", 15)
+        self.export_spool_size = getattr(bot.config, "export_spool_size", 1024 * 1024)
+        self.export_fetch_batch = getattr(bot.config, "export_fetch_batch", 20)
+        self.backfills = {}
+        # Replaced by the guild_settings table once the database is ready
+        self.settings = SettingsRegistry.from_config(bot.config)
+        self.level_tables = {}
+        self.flushing = None
+        self.rankings = {}
+        self.activity_window_days = getattr(bot.config, "activity_window_days", 30)
+        self.activity_hourly_days = getattr(bot.config, "activity_hourly_days", 2)
+        self.activity_retention_days = getattr(
+            bot.config, "activity_retention_days", 400
+        )
+        self.members = MemberResolver(
+            bot,
+            getattr(bot.config, "member_cache_size", 50000),
+            getattr(bot.config, "member_cache", "full") == "low",
+            self,
+        )
+        self.profiles = ProfileCache(
+            getattr(bot.config, "profile_cache_size", 50000),
+            timedelta(days=getattr(bot.config, "profile_refresh_days", 7)),
+        )
+        self.profile_refresh_batch = getattr(bot.config, "profile_refresh_batch", 50)
+        self.count_cache = CountCache(
+            getattr(bot.config, "count_cache_size", 100000),
+            getattr(bot.config, "count_cache_ttl", 300.0),
+        )
+        # Messages within the activity window, flushes add their deltas
+        self.activity_cache = CountCache(
+            getattr(bot.config, "count_cache_size", 100000),
+            getattr(bot.config, "count_cache_ttl", 300.0),
+        )
+        messages = bot.metrics.counter(
+            "postnrole_messages_total", "Messages seen by the counter", ["result"]
+        )
+        self.messages_counted = messages.labels("counted")
+        self.messages_filtered = messages.labels("filtered")
+        self.flush_duration = bot.metrics.histogram(
+            "postnrole_flush_duration_seconds", "Time taken by count flushes"
+        )
+        self.flush_rows = bot.metrics.histogram(
+            "postnrole_flush_rows",
+            "Rows written per count flush",
+            buckets=(10, 100, 1000, 5000, 10000, 50000, 100000),
+        )
+        self.backfill_scanned = bot.metrics.counter(
+            "postnrole_backfill_messages_total", "Messages scanned by init backfills"
+        )
+        bot.metrics.gauge(
+            "postnrole_pending_rows",
+            "Rows waiting for the next count flush",
+            lambda: self.message_count.rows,
+        )
+        bot.metrics.gauge(
+            "postnrole_pending_bytes",
+            "Approximate memory held by the pending buffer",
+            lambda: self.message_count.footprint(),
+        )
+        self.roles = RoleReconciler(self, getattr(bot.config, "role_workers", 2))
+        bot.metrics.gauge(
+            "postnrole_role_queue",
+            "Members waiting for their level roles to be reconciled",
+            lambda: len(self.roles),
+        )
+        bot.metrics.gauge(
+            "postnrole_cached_profiles",
+            "User profiles kept in memory",
+            lambda: len(self.profiles),
+        )
+        bot.metrics.gauge(
+            "postnrole_recent_members",
+            "Members kept by the counter in the low memory mode",
+            lambda: len(self.members),
+        )
+        bot.metrics.gauge(
+            "postnrole_backfills_running",
+            "Init backfills in progress",
+            lambda: len(self.backfills),
+        )
+        self.drain_deadline = getattr(bot.config, "shutdown_deadline", 10.0)
+        # After a failed flush on_message leaves retrying to the loop until then
+        self.flush_retry_at = 0.0
+        self.unloaded = False
+        self.journal = None
+        journal_path = getattr(bot.config, "journal_path", None)
+        handoff = bot.loader.take_handoff("counter")
+        if handoff:
+            # A reload, the buffer and journal of the previous instance carry on
+            # and its flush lock keeps a flush it still runs ahead of ours
+            self.message_count, self.journal, self.flush_lock, self.profiles = handoff
+        elif journal_path:
+            self.journal = Journal(journal_path)
+            # Counts that didn't make it to the database before the last shutdown
+            for (guild_id, user_id), count in self.journal.replay().items():
+                self.message_count.add(guild_id, user_id, count)
+        self.bulk_count_update.change_interval(
+            seconds=getattr(bot.config, "flush_interval", 30.0)
+        )
+        bot.tasks.spawn("startup", self.wait_for_db(), owner=self)
 
     async def wait_for_db(self):
-        if not self.bot.cogs["Database"]:
-            self.bot.logger.error(
-                "The counter cog couldn't be loaded because the database cog is not loaded."
-            )
-            self.bot.unload_extension(self.__class__.__module__)
-        try:
-            while not self.bot.db.is_ready:
-                await sleep(0.5)
-        except (NameError, AttributeError):
-            # The database connection wasn't made, db has been unloaded
+        # Messages are already counted into the buffer while this waits
+        if not await self.bot.loader.wait_ready("database"):
             self.bot.logger.error("The counter cog unloaded. DB cog didn't connect.")
+            self.bot.loader.set_failed("counter")
             return self.bot.unload_extension(self.__class__.__module__)
+        await self.settings.load(self.bot.db.storage)
+        self.level_tables.clear()
         self.bulk_count_update.start()
+        self.activity_rollup.start()
+        self.refresh_profiles.start()
         self.bot.logger.info("The counter cog has been loaded.")
+        self.bot.loader.set_ready("counter")
+        await self.resume_backfills()
+
+    async def resume_backfills(self):
+        """Continues backfills that were interrupted by a restart."""
+        await self.bot.wait_until_ready()
+        for (
+            guild_id,
+            boundary_id,
+            channel_id,
+            message_id,
+        ) in await self.bot.db.storage.list_backfills():
+            guild = self.bot.get_guild(guild_id)
+            if not guild or guild_id in self.backfills:
+                continue
+            progress_message = None
+            channel = guild.get_channel(channel_id)
+            if channel:
+                try:
+                    progress_message = await channel.fetch_message(message_id)
+                except HTTPException:
+                    pass
+            self.bot.logger.info(f"Resuming the interrupted backfill of {guild_id}.")
+            await self.start_backfill(
+                Backfill(self, guild, boundary_id, progress_message), wait=True
+            )
+
+    async def start_backfill(self, backfill, wait=False):
+        """Runs the backfill as the cog's task, so unloading the cog stops it.
+
+        Returns the task, or None if the backfill group's queue is full,
+        with wait it waits for room instead.
+        """
+        # Taken right away, a second init or resume sees it before the task starts
+        self.backfills[backfill.guild.id] = backfill
+        coro = self.run_backfill(backfill)
+        task = None
+        try:
+            if wait:
+                task = await self.bot.tasks.submit("backfill", coro, owner=self)
+            else:
+                task = self.bot.tasks.spawn("backfill", coro, owner=self)
+        finally:
+            if task is None:
+                del self.backfills[backfill.guild.id]
+        return task
+
+    async def run_backfill(self, backfill):
+        try:
+            finished = await backfill.run()
+        finally:
+            del self.backfills[backfill.guild.id]
+            self.count_cache.invalidate_guild(backfill.guild.id)
+            self.activity_cache.invalidate_guild(backfill.guild.id)
+            self.rankings.pop(backfill.guild.id, None)
+        if not backfill.progress_message:
+            return
+        if not finished:
+            return await backfill.progress_message.edit(
+                content="Some channels couldn't be read right now. "
+                "Use the init command again later to continue."
+            )
+        await backfill.progress_message.delete()
+        await backfill.progress_message.channel.send(
+            "The initialization has been finished!"
+        )
+
+    async def run_init(self, ctx, backfill):
+        task = await self.start_backfill(backfill)
+        if task is None:
+            return await ctx.send(
+                "Too many initializations are running, please try again later."
+            )
+        # Without re-raising, the task's failure is already reported
+        await wait((task,))
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        if not guild.id in self.bot.config.counted_guilds:
+        if not self.settings.is_counted(guild.id):
             return
         channels = [
             channel
@@ -58,139 +249,508 @@ class Counter(commands.Cog):
             )
         ]
         content = "Thank you for adding me to this server!\n\nI am a bot made to track user activity."
-        if not all(
-            [
-                discord_get(guild.roles, name="Level 1"),
-                discord_get(guild.roles, name="Level 2"),
-                discord_get(guild.roles, name="Level 3"),
-            ]
-        ):
+        table = self.level_table(guild)
+        if not all(table.role_ids):
             content += (
-                "\n\nI have noticed that the roles are not yet set up. Please create a role named Level 1, Level 2 and Level 3 to continue using the bot!"
+                f"\n\nI have noticed that the roles are not yet set up. Please create a role named {', '.join(table.names)} to continue using the bot!"
                 "Else the bot will not be able to assign roles in the future. Also make sure to move the bot's role above them so it will have permission to assign them in the future."
             )
         content += f"\n\nOnce everything else is done, make sure to run `{self.bot.config.prefix}init` as the owner to intialize the counter."
         embed = Embed(
             title=f"Welcome {guild.name}!", description=content, color=0x39FF14
         )
+        # Not cached in the low memory mode
+        owner = guild.owner or await self.bot.fetch_user(guild.owner_id)
         for channel in channels:
             try:
-                await channel.send(content=guild.owner.mention, embed=embed)
+                await channel.send(content=owner.mention, embed=embed)
                 return
             except:
                 continue
         try:
-            await guild.owner.send(embed=embed)
+            await owner.send(embed=embed)
         except:
             await guild.leave()
 
+    def is_countable(self, message, settings):
+        if message.author.bot:
+            return False
+        if message.author.id == message.guild.owner_id:
+            return False
+        if message.channel.id in settings.excluded_channels:
+            return False
+        # Counting the separators doesn't build the list split() would
+        if message.content.count(" ") < settings.min_words - 1:
+            return False
+        return True
+
     @commands.Cog.listener()
     async def on_message(self, message):
-        if message.author.bot:
-            return
-        if not message.guild:
-            return
-        if message.author.id == message.guild.owner.id:
-            return
-        if len(message.content.split(" ")) < 3:
-            return
-        if not message.guild.id in self.bot.config.counted_guilds:
-            return
-        async with self.lock:
-            if not self.message_count.get(message.guild.id):
-                self.message_count[message.guild.id] = {}
-                self.message_count[message.guild.id][message.author.id] = 1
-            elif not message.author.id in self.message_count[message.guild.id]:
-                self.message_count[message.guild.id][message.author.id] = 1
-            else:
-                self.message_count[message.guild.id][message.author.id] += 1
+        settings = self.settings.get(message.guild.id) if message.guild else None
+        if (
+            not settings
+            or not settings.enabled
+            or not self.is_countable(message, settings)
+        ):
+            return self.messages_filtered.inc()
+        if self.message_count.add(message.guild.id, message.author.id):
+            self.messages_counted.inc()
+            self.members.remember(message.author)
+            self.profiles.seen(message.guild.id, message.author)
+            if self.journal:
+                self.journal.append(message.guild.id, message.author.id)
+        if (
+            self.message_count.rows >= self.flush_threshold
+            and self.bulk_count_update.is_running()
+            and not self.flush_lock.locked()
+            and monotonic() >= self.flush_retry_at
+        ):
+            # Busy guilds shouldn't build up a whole loop interval of backlog.
+            # Not owned by the cog, an unload lets the flush finish
+            self.bot.tasks.spawn("flush", self.flush())
 
-    async def check_level_up(self, member, new_message_count: int):
-        async def _add_role(member, name: str):
-            try:
-                level_roles = [role for role in member.roles if "Level" in role.name]
-                if level_roles:
-                    await member.remove_roles(*level_roles, reason="Auto levelup role")
-                await member.add_roles(
-                    discord_get(member.guild.roles, name=name),
-                    reason="Auto levelup role",
-                )
-            except Forbidden:
-                bot_log = discord_get(member.guild.text_channels, name="bot-log")
-                if bot_log:
-                    await bot_log.send(
-                        f"Couldn't level up member `{member}` due to missing permissions to {name}"
+    def level_table(self, guild):
+        table = self.level_tables.get(guild.id)
+        if table is None:
+            settings = self.settings.get(guild.id)
+            rules = (settings and settings.level_rules) or DEFAULT_LEVEL_RULES
+            table = self.level_tables[guild.id] = LevelTable(guild, rules)
+        return table
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.members.forget_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if self.settings.is_counted(member.guild.id):
+            self.profiles.seen(member.guild.id, member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        if self.settings.is_counted(member.guild.id):
+            self.profiles.seen(member.guild.id, member, is_member=False)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        if str(before) != str(after):
+            self.profiles.renamed(
+                after.id, str(after), [guild.id for guild in self.bot.guilds]
+            )
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        self.level_tables.pop(role.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if before.name != after.name:
+            self.level_tables.pop(after.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        self.level_tables.pop(role.guild.id, None)
+
+    async def read_cached(self, cache, guild_id, user_id, read):
+        """Returns a persisted count from the cache, read() loads it on a miss."""
+        if guild_id in self.backfills:
+            # The guild's counts are being rebuilt
+            return await read() or 0
+        count = cache.get(guild_id, user_id)
+        for _ in range(READ_ATTEMPTS):
+            if count is not None:
+                return count
+            version = cache.version
+            persisted = await read() or 0
+            # None when a flush finished meanwhile that the read may have missed
+            count = cache.fill(guild_id, user_id, persisted, version)
+        # Flushes kept overlapping the reads, the last one is close enough
+        return persisted if count is None else count
+
+    def pending_count(self, guild_id, user_id):
+        pending = self.message_count.get(guild_id, user_id)
+        if self.flushing:
+            pending += self.flushing.get(guild_id, user_id)
+        return pending
+
+    async def get_count(self, guild_id, user_id):
+        """Returns the persisted count plus what's still waiting to be flushed."""
+        persisted = await self.read_cached(
+            self.count_cache,
+            guild_id,
+            user_id,
+            lambda: self.bot.db.storage.get_count(guild_id, user_id),
+        )
+        return persisted + self.pending_count(guild_id, user_id)
+
+    def activity_since(self):
+        return datetime.now(timezone.utc) - timedelta(days=self.activity_window_days)
+
+    async def get_recent_activity(self, guild_id, user_id):
+        """Returns the messages counted within the activity window."""
+        persisted = await self.read_cached(
+            self.activity_cache,
+            guild_id,
+            user_id,
+            lambda: self.bot.db.storage.user_activity(
+                guild_id, user_id, self.activity_since()
+            ),
+        )
+        return persisted + self.pending_count(guild_id, user_id)
+
+    async def get_ranking(self, guild_id):
+        ranking = self.rankings.get(guild_id)
+        if ranking is None:
+            # Holding the flush lock keeps flushed rows from slipping past the load
+            async with self.flush_lock:
+                ranking = self.rankings.get(guild_id)
+                if ranking is None:
+                    ranking = self.rankings[guild_id] = GuildRanking(
+                        [row async for row in self.bot.db.storage.iter_guild(guild_id)]
                     )
+        return ranking
 
-        if not member:
+    async def flush(self):
+        async with self.flush_lock:
+            if self.unloaded:
+                # The buffer belongs to the next instance or to drain() now
+                return
+            await self.flush_locked()
+
+    async def flush_locked(self):
+        """Writes the pending buffer, the caller has to hold the flush lock."""
+        # Detach the whole buffer at once, on_message keeps counting into the new one
+        pending, self.message_count = self.message_count, PendingCounts(
+            self.pending_limit
+        )
+        if pending.dropped:
+            self.bot.logger.warning(
+                f"The pending buffer was full, {pending.dropped} messages weren't counted."
+            )
+        if not pending:
             return
-        user_active_since = (datetime.now() - member.joined_at).days
-        if (
-            not discord_get(member.roles, name="Level 3")
-            and user_active_since > 7 * 12
-            and new_message_count >= 100
-        ):
-            return await _add_role(member, "Level 3")
-        elif (
-            not discord_get(member.roles, name="Level 3")
-            and not discord_get(member.roles, name="Level 2")
-            and user_active_since > 7 * 6
-            and new_message_count >= 48
-        ):
-            return await _add_role(member, "Level 2")
-        elif (
-            not discord_get(member.roles, name="Level 3")
-            and not discord_get(member.roles, name="Level 2")
-            and not discord_get(member.roles, name="Level 1")
-            and new_message_count >= 12
-        ):
-            return await _add_role(member, "Level 1")
+        segments = None
+        if self.journal and not self.journal.sealed:
+            segments = self.journal.seal()
+        # Otherwise a flush failed before, the sealed segments hold part of
+        # what's pending again and retries would each add one more
+        rows = list(pending.items())
+        hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        started = perf_counter()
+        # Keeps the counts visible to get_count while they're being written
+        self.flushing = pending
+        try:
+            results = await self.bot.db.storage.upsert_counts(rows, hour)
+        except Exception as e:
+            # Put the counts back so the next flush retries them, their
+            # journal segments stay until a flush succeeds
+            self.message_count.merge(pending)
+            # The buffer stays over the threshold, every message would retry
+            self.flush_retry_at = monotonic() + self.bulk_count_update.seconds
+            self.bot.errors.report("counter flush", e)
+            return
+        except CancelledError:
+            # Cut off by the drain deadline, the counts show up as not drained
+            self.message_count.merge(pending)
+            raise
+        finally:
+            self.flushing = None
+        self.flush_retry_at = 0.0
+        if segments:
+            self.journal.release(segments)
+        elif self.journal:
+            # Holding what was just written and what was counted meanwhile
+            self.journal.rewrite(self.message_count.items())
+        duration = perf_counter() - started
+        self.flush_duration.observe(duration)
+        self.flush_rows.observe(len(rows))
+        self.bot.logger.debug(
+            f"Flushed {len(rows)} counts ({pending.footprint()} bytes buffered) in {duration:.3f}s"
+        )
+        for guild_id, user_id, new_message_count in results:
+            if guild_id not in self.backfills:
+                self.count_cache.set(guild_id, user_id, new_message_count)
+                self.activity_cache.add(
+                    guild_id, user_id, pending.get(guild_id, user_id)
+                )
+            ranking = self.rankings.get(guild_id)
+            if ranking:
+                ranking.update(user_id, new_message_count)
+            if self.bot.get_guild(guild_id):
+                self.roles.submit(guild_id, user_id, new_message_count)
 
     @tasks.loop(seconds=30.0)
     async def bulk_count_update(self):
-        while self.message_count:
-            async with self.lock:
-                guild_id, counts = self.message_count.popitem()
-            for user_id, message_count in counts.items():
-                if await self.bot.db.pool.fetchval(
-                    "SELECT message_count FROM message_count WHERE guild_id=$1 AND user_id=$2",
-                    guild_id,
-                    user_id,
-                ):
-                    new_message_count = await self.bot.db.pool.fetchval(
-                        "UPDATE message_count SET message_count=message_count+$1 RETURNING message_count",
-                        message_count,
-                    )
-                else:
-                    await self.bot.db.pool.execute(
-                        "INSERT INTO message_count (guild_id, user_id, message_count) VALUES ($1, $2, $3) RETURNING message_count",
-                        guild_id,
-                        user_id,
-                        message_count,
-                    )
-                    new_message_count = message_count
-                self.bot.loop.create_task(
-                    self.check_level_up(
-                        self.bot.get_guild(guild_id).get_member(user_id),
-                        new_message_count,
-                    )
-                )
+        await self.flush()
+        await self.flush_profiles()
+
+    async def flush_profiles(self):
+        pending = self.profiles.pending
+        try:
+            await self.profiles.flush(self.bot.db.storage)
+        except Exception:
+            self.bot.logger.exception(
+                f"Couldn't write {pending} user profiles, retrying on the next run."
+            )
+
+    @tasks.loop(minutes=10)
+    async def refresh_profiles(self):
+        """Looks up the names of a few users whose profile is stale."""
+        before = datetime.now(timezone.utc) - self.profiles.refresh_after
+        # Only this process's guilds, the other processes of a cluster look
+        # up the users of theirs
+        guild_ids = [guild.id for guild in self.bot.guilds]
+        try:
+            user_ids = await self.bot.db.storage.stale_profiles(
+                before, self.profile_refresh_batch, guild_ids
+            )
+        except Exception:
+            return self.bot.logger.exception("Couldn't read the stale user profiles.")
+        for user_id in user_ids:
+            # The gateway keeps cached users current, others cost a REST call
+            user = self.bot.get_user(user_id)
+            if user is None:
+                try:
+                    user = await self.bot.fetch_user(user_id)
+                except NotFound:
+                    user = "Deleted User"
+                except HTTPException:
+                    continue
+            self.profiles.renamed(user_id, str(user), guild_ids)
+
+    @tasks.loop(hours=1)
+    async def activity_rollup(self):
+        try:
+            await self.bot.db.storage.rollup_activity(
+                datetime.now(timezone.utc),
+                self.activity_hourly_days,
+                self.activity_retention_days,
+            )
+        except Exception:
+            self.bot.logger.exception("Couldn't roll up the activity buckets.")
 
     def cog_unload(self):
-        self.bulk_count_update.cancel()
+        # A flush in progress finishes, cancelling it could lose its rows
+        self.bulk_count_update.stop()
+        self.activity_rollup.cancel()
+        self.refresh_profiles.cancel()
+        self.bot.tasks.cancel_owner(self)
+        self.unloaded = True
+        # Taken over by the next instance on a reload, drain() flushes it otherwise
+        self.bot.loader.hand_off(
+            "counter",
+            (self.message_count, self.journal, self.flush_lock, self.profiles),
+        )
+        self.bot.tasks.spawn("drain", self.drain())
+
+    async def drain(self):
+        """Flushes the buffer after an unload, unless a reload took it over."""
+        handoff = self.bot.loader.handoffs.get("counter")
+        if not handoff or handoff[0] is not self.message_count:
+            return
+        self.bot.loader.take_handoff("counter")
+        rows = self.message_count.rows
+        started = perf_counter()
+        try:
+            await wait_for(self._drain_locked(), self.drain_deadline)
+        except TimeoutError:
+            pass
+        finally:
+            if self.journal:
+                self.journal.close()
+        elapsed = perf_counter() - started
+        left = self.message_count.rows
+        if left:
+            self.bot.logger.warning(
+                f"Drained {rows - left} of {rows} pending rows in {elapsed:.3f}s, "
+                + (
+                    "the rest is replayed from the journal on the next start."
+                    if self.journal
+                    else "the rest is lost."
+                )
+            )
+        else:
+            self.bot.logger.info(f"Drained {rows} pending rows in {elapsed:.3f}s.")
+
+    async def _drain_locked(self):
+        async with self.flush_lock:
+            await self.flush_locked()
+        await self.flush_profiles()
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def pending(self, ctx):
+        """Shows the size of the buffer waiting for the next flush"""
+        buffer = self.message_count
+        await ctx.send(
+            f"**Pending rows:** `{buffer.rows}`/`{self.pending_limit}` across `{len(buffer.guilds)}` guilds\n"
+            f"**Approximate size:** `{round(buffer.footprint() / 1024, 2)}` KiB\n"
+            f"**Dropped messages:** `{buffer.dropped}`\n"
+            f"**Count cache:** `{len(self.count_cache)}`/`{self.count_cache.maxsize}` entries, "
+            f"`{self.count_cache.hits}` hits, `{self.count_cache.misses}` misses\n"
+            f"**Role queue:** `{len(self.roles)}` members across `{len(self.roles.pending)}` guilds\n"
+            f"**User profiles:** `{len(self.profiles)}`/`{self.profiles.maxsize}` cached, "
+            f"`{self.profiles.pending}` waiting to be written",
+            reference=ctx.message,
+            mention_author=False,
+        )
+
+    async def update_settings(self, ctx, **changes):
+        settings = await self.settings.update(ctx.guild.id, **changes)
+        self.level_tables.pop(ctx.guild.id, None)
+        if self.bot.cluster:
+            self.bot.cluster.send("settings", ctx.guild.id)
+        await self.send_settings(ctx, settings)
+
+    async def send_settings(self, ctx, settings):
+        rules = settings.level_rules or DEFAULT_LEVEL_RULES
+        content = (
+            f"**Counting:** `{'enabled' if settings.enabled else 'disabled'}`\n"
+            f"**Minimum words:** `{settings.min_words}`\n"
+            f"**Excluded channels:** "
+            + (
+                " ".join(
+                    f"<#{channel_id}>" for channel_id in settings.excluded_channels
+                )
+                or "`none`"
+            )
+            + "\n**Levels:**"
+            + ("" if settings.level_rules else " `default`")
+            + "".join(
+                f"\n`{rule.role}`: `{rule.messages}` messages, `{rule.days}` days"
+                for rule in rules
+            )
+        )
+        await ctx.send(
+            embed=Embed(
+                title=f"{ctx.guild.name}'s settings",
+                description=content,
+                color=0x39FF14,
+            ),
+            reference=ctx.message,
+            mention_author=False,
+        )
+
+    @commands.Cog.listener()
+    async def on_cluster_settings(self, guild_id):
+        await self.settings.reload(guild_id)
+        self.level_tables.pop(guild_id, None)
+
+    @is_guild_owner()
+    @commands.group(name="settings", invoke_without_command=True)
+    async def _settings(self, ctx):
+        """Shows the counter settings of this guild"""
+        settings = self.settings.get(ctx.guild.id)
+        if not settings:
+            return await ctx.send(
+                "This command is not intended to be used on this guild."
+            )
+        await self.send_settings(ctx, settings)
+
+    @commands.guild_only()
+    @commands.is_owner()
+    @_settings.command()
+    async def enable(self, ctx):
+        """Starts counting messages on this guild"""
+        await self.update_settings(ctx, enabled=True)
+
+    @commands.guild_only()
+    @commands.is_owner()
+    @_settings.command()
+    async def disable(self, ctx):
+        """Stops counting messages on this guild"""
+        await self.update_settings(ctx, enabled=False)
+
+    @is_guild_owner()
+    @_settings.command()
+    async def minwords(self, ctx, words: int):
+        """Sets how many words a message needs to be counted"""
+        if not self.settings.get(ctx.guild.id):
+            return await ctx.send(
+                "This command is not intended to be used on this guild."
+            )
+        await self.update_settings(ctx, min_words=max(words, 1))
+
+    @is_guild_owner()
+    @_settings.command()
+    async def exclude(self, ctx, channel: TextChannel):
+        """Stops counting messages in a channel"""
+        settings = self.settings.get(ctx.guild.id)
+        if not settings:
+            return await ctx.send(
+                "This command is not intended to be used on this guild."
+            )
+        await self.update_settings(
+            ctx, excluded_channels=settings.excluded_channels | {channel.id}
+        )
+
+    @is_guild_owner()
+    @_settings.command()
+    async def include(self, ctx, channel: TextChannel):
+        """Counts messages in an excluded channel again"""
+        settings = self.settings.get(ctx.guild.id)
+        if not settings:
+            return await ctx.send(
+                "This command is not intended to be used on this guild."
+            )
+        await self.update_settings(
+            ctx, excluded_channels=settings.excluded_channels - {channel.id}
+        )
+
+    @is_guild_owner()
+    @_settings.command()
+    async def levels(self, ctx, *rules):
+        """Sets the level roles as `"role" messages days` triples, none resets them"""
+        if not self.settings.get(ctx.guild.id):
+            return await ctx.send(
+                "This command is not intended to be used on this guild."
+            )
+        if len(rules) % 3:
+            return await ctx.send(
+                'Pass every level as `"role name" messages days`, e.g. `"Level 1" 12 0`.'
+            )
+        try:
+            level_rules = tuple(
+                LevelRule(rules[i], int(rules[i + 1]), int(rules[i + 2]))
+                for i in range(0, len(rules), 3)
+            )
+        except ValueError:
+            return await ctx.send(
+                "The messages and days of a level have to be numbers."
+            )
+        await self.update_settings(ctx, level_rules=level_rules or None)
 
     @is_guild_owner()
     @commands.command(name="init", aliases=["initialize"])
     async def _init(self, ctx):
         """Initialize the bot database for the given guild."""
-        if not ctx.guild.id in self.bot.config.counted_guilds:
+        if not self.settings.is_counted(ctx.guild.id):
             return await ctx.send(
                 "This command is not intended to be used on this guild."
             )
+        if ctx.guild.id in self.backfills:
+            return await ctx.send(
+                "The initialization is already running on this guild.",
+                reference=ctx.message,
+                mention_author=False,
+            )
+        boundary_id = await self.bot.db.storage.get_backfill(ctx.guild.id)
+        if boundary_id:
+            # Left over from a run that was interrupted and couldn't be resumed
+            progress_message = await ctx.send(
+                "Resuming the interrupted initialization.",
+                reference=ctx.message,
+                mention_author=False,
+            )
+            return await self.run_init(
+                ctx, Backfill(self, ctx.guild, boundary_id, progress_message)
+            )
+        excluded_channels = self.settings.get(ctx.guild.id).excluded_channels
         logged_channels = [
             channel
             for channel in ctx.guild.text_channels
-            if channel.permissions_for(ctx.guild.me).read_messages
+            if channel.id not in excluded_channels
+            and channel.permissions_for(ctx.guild.me).read_messages
             and channel.permissions_for(ctx.guild.me).read_message_history
         ]
         confirmation_message = await ctx.send(
@@ -216,124 +776,107 @@ class Counter(commands.Cog):
         if str(reaction.emoji) == "❌":
             return await confirmation_message.delete()
 
-        self.bulk_count_update.cancel()
         await confirmation_message.remove_reaction("✅", member=ctx.guild.me)
         await confirmation_message.remove_reaction("❌", member=ctx.guild.me)
         await confirmation_message.edit(
             content="Analyzing messages. Hold tight, this will take a bit."
         )
-
-        user_message_count = {}
-
-        for channel in logged_channels:
-            async for message in channel.history(limit=None):
-                if message.author.bot:
-                    continue
-                if message.author.id == message.guild.owner.id:
-                    continue
-                if len(message.content.split(" ")) < 3:
-                    continue
-                if user_message_count.get(message.author.id):
-                    user_message_count[message.author.id] += 1
-                else:
-                    user_message_count[message.author.id] = 1
-
-        await confirmation_message.edit(content="Messages counted! Saving....")
-
-        for user_id, message_count in user_message_count.items():
-            if await self.bot.db.pool.fetchval(
-                "SELECT message_count FROM message_count WHERE guild_id=$1 AND user_id=$2",
-                ctx.guild.id,
-                user_id,
-            ):
-                await self.bot.db.pool.fetchval(
-                    "UPDATE message_count SET message_count=$1 RETURNING message_count",
-                    message_count,
-                )
-            else:
-                await self.bot.db.pool.execute(
-                    "INSERT INTO message_count (guild_id, user_id, message_count) VALUES ($1, $2, $3) RETURNING message_count",
-                    ctx.guild.id,
-                    user_id,
-                    message_count,
-                )
-            self.bot.loop.create_task(
-                self.check_level_up(
-                    self.bot.get_guild(ctx.guild.id).get_member(user_id), message_count
-                )
-            )
-
-        await confirmation_message.delete()
-        await ctx.send(
-            "The initialization has been finished!",
-            reference=ctx.message,
-            mention_author=True,
+        await self.run_init(
+            ctx,
+            await Backfill.start(
+                self, ctx.guild, logged_channels, confirmation_message
+            ),
         )
-        self.bulk_count_update.start()
 
     @is_guild_owner()
     @commands.command()
-    async def gencsv(self, ctx):
-        """Generate a CSV table with statistics"""
-        if not ctx.guild.id in self.bot.config.counted_guilds:
+    async def gencsv(self, ctx, compress: bool = False):
+        """Generate a CSV table with statistics, pass `yes` to gzip it"""
+        if not self.settings.is_counted(ctx.guild.id):
             return await ctx.send(
                 "This command is not intended to be used on this guild."
             )
-        values = await self.bot.db.pool.fetch(
-            "SELECT user_id, message_count FROM message_count WHERE guild_id=$1",
-            ctx.guild.id,
-        )
-        output = StringIO()
-        writer = DictWriter(
-            output, fieldnames=["user_id", "username", "joined_at", "message_count"]
-        )
-        writer.writeheader()
-        for user_id, message_count in values:
-            if ctx.guild.get_member(user_id):
-                username = ctx.guild.get_member(user_id)
-                joined_at = username.joined_at.astimezone(utc)
-            else:
-                try:
-                    username = await self.bot.fetch_user(user_id)
-                except NotFound:
-                    username = "Deleted User"
-                joined_at = ""
-            writer.writerow(
-                {
-                    "user_id": user_id,
-                    "username": username,
-                    "joined_at": joined_at,
-                    "message_count": message_count,
-                }
+        async with ctx.typing():
+            parts = await CSVExport(self, ctx.guild, compress).run()
+        filename = f"userdata_{int(time())}"
+        extension = "csv.gz" if compress else "csv"
+        try:
+            for index, part in enumerate(parts, start=1):
+                name = (
+                    f"{filename}_part{index}.{extension}"
+                    if len(parts) > 1
+                    else f"{filename}.{extension}"
+                )
+                await ctx.send(
+                    (
+                        "Find the table attached below!"
+                        if len(parts) == 1
+                        else f"Find part {index} of {len(parts)} of the table attached below!"
+                    ),
+                    file=File(filename=name, fp=part),
+                    reference=ctx.message,
+                    mention_author=False,
+                )
+        finally:
+            for part in parts:
+                part.close()
+
+    @commands.guild_only()
+    @commands.command(aliases=["lb", "top"])
+    async def leaderboard(self, ctx, page: int = 1):
+        """Displays the members with the most counted messages"""
+        if not self.settings.is_counted(ctx.guild.id):
+            return await ctx.send(
+                "This command is not intended to be used on this guild."
             )
-        output.seek(0)
-        await ctx.send(
-            "Find the table attached below!",
-            file=File(filename=f"userdata_{int(time())}.csv", fp=output),
-            reference=ctx.message,
-            mention_author=False,
+        if ctx.guild.id in self.backfills:
+            return await ctx.send(
+                "The leaderboard is available once the initialization has finished.",
+                reference=ctx.message,
+                mention_author=False,
+            )
+        ranking = await self.get_ranking(ctx.guild.id)
+        pages = max((len(ranking) - 1) // LEADERBOARD_PAGE_SIZE + 1, 1)
+        page = min(max(page, 1), pages)
+        entries = ranking.page(
+            (page - 1) * LEADERBOARD_PAGE_SIZE, LEADERBOARD_PAGE_SIZE
         )
-        output.close()
+        content = "\n".join(
+            f"`#{rank}` <@{user_id}>: `{message_count}` messages"
+            for rank, user_id, message_count in entries
+        )
+        own_rank = ranking.rank(ctx.author.id)
+        embed = Embed(
+            title=f"{ctx.guild.name}'s leaderboard",
+            description=content or "No messages have been counted yet.",
+            color=0x39FF14,
+        )
+        embed.set_footer(
+            text=f"Page {page}/{pages}"
+            + (f" | Your rank: #{own_rank}" if own_rank else "")
+        )
+        await ctx.send(embed=embed, reference=ctx.message, mention_author=False)
 
     @commands.guild_only()
     @commands.command()
     async def userinfo(self, ctx, *, member: Member = None):
         """Displays information regarding a specific user"""
-        if not ctx.guild.id in self.bot.config.counted_guilds:
+        if not self.settings.is_counted(ctx.guild.id):
             return await ctx.send(
                 "This command is not intended to be used on this guild."
             )
         if not member:
             member = ctx.author
-        message_count = await self.bot.db.pool.fetchval(
-            "SELECT message_count FROM message_count WHERE guild_id=$1 AND user_id=$2",
-            ctx.guild.id,
-            member.id,
-        )
+        message_count = await self.get_count(ctx.guild.id, member.id)
         if not message_count:
             message_count = "not accounted"
+        recent_messages = await self.get_recent_activity(ctx.guild.id, member.id)
         user_active_since = (datetime.now() - member.joined_at).days
-        content = f"**Counted messages:** `{message_count}`\n**On the server for:** `{user_active_since}` days"
+        content = (
+            f"**Counted messages:** `{message_count}`\n"
+            f"**In the last {self.activity_window_days} days:** `{recent_messages}`\n"
+            f"**On the server for:** `{user_active_since}` days"
+        )
         embed = Embed(
             title=f"{member}'s stats",
             description=content,
@@ -0,0 +1,170 @@
+from asyncio import Semaphore, gather, sleep
+from collections import Counter
+from datetime import datetime
+from time import perf_counter
+
+from discord import Forbidden, HTTPException, NotFound, Object
+from discord.utils import time_snowflake
+
+from .settings import make_settings
+
+
+class Backfill:
+    """Counts a guild's message history channel by channel.
+
+    Every channel is read oldest first up to the boundary message id, which
+    separates the history from what on_message counts live. Partial counts
+    are written together with the channel's last processed message id, so an
+    interrupted backfill picks up where it stopped without counting twice.
+    """
+
+    def __init__(self, cog, guild, boundary_id, progress_message=None):
+        self.cog = cog
+        self.bot = cog.bot
+        self.guild = guild
+        self.boundary_id = boundary_id
+        self.progress_message = progress_message
+        self.channels_total = 0
+        self.channels_done = 0
+        # Channels that stopped on a transient error, left for a resume
+        self.channels_failed = 0
+        self.scanned = 0
+        self.counted = 0
+        self.started = perf_counter()
+
+    @property
+    def rate(self):
+        return self.scanned / max(perf_counter() - self.started, 1e-9)
+
+    def progress(self):
+        return (
+            f"Analyzing messages. Hold tight, this will take a bit.\n\n"
+            f"**Channels:** `{self.channels_done}`/`{self.channels_total}`\n"
+            f"**Messages scanned:** `{self.scanned}` (`{round(self.rate, 1)}`/s)\n"
+            f"**Messages counted:** `{self.counted}`"
+        )
+
+    @classmethod
+    async def start(cls, cog, guild, channels, progress_message):
+        """Resets the guild's counts and records a fresh backfill."""
+        async with cog.flush_lock:
+            # Write out the buffer first so the journal doesn't replay counts
+            # from before the boundary, what arrived since is part of the history
+            await cog.flush_locked()
+            cog.message_count.discard(guild.id)
+            if cog.journal:
+                # What arrived during the flush is journaled too, drop it there
+                cog.journal.rewrite(cog.message_count.items())
+            boundary_id = time_snowflake(datetime.utcnow())
+            await cog.bot.db.storage.start_backfill(
+                guild.id,
+                boundary_id,
+                progress_message.channel.id,
+                progress_message.id,
+                [channel.id for channel in channels],
+            )
+            cog.count_cache.invalidate_guild(guild.id)
+            cog.activity_cache.invalidate_guild(guild.id)
+            cog.rankings.pop(guild.id, None)
+        return cls(cog, guild, boundary_id, progress_message)
+
+    async def run(self):
+        """Returns whether every channel was read, otherwise it's left to resume."""
+        (
+            self.channels_total,
+            checkpoints,
+        ) = await self.bot.db.storage.backfill_checkpoints(self.guild.id)
+        self.channels_done = self.channels_total - len(checkpoints)
+        semaphore = Semaphore(self.cog.init_concurrency)
+
+        async def _scan(channel_id, last_message_id):
+            async with semaphore:
+                await self.scan_channel(channel_id, last_message_id)
+            self.channels_done += 1
+
+        reporter = self.bot.tasks.spawn(
+            "backfill-progress", self.report_progress(), owner=self.cog
+        )
+        scans = [
+            self.bot.loop.create_task(_scan(*checkpoint)) for checkpoint in checkpoints
+        ]
+        try:
+            await gather(*scans)
+        finally:
+            reporter.cancel()
+            # One scan failing leaves the others running otherwise
+            for scan in scans:
+                scan.cancel()
+            await gather(*scans, return_exceptions=True)
+        if self.channels_failed:
+            self.bot.logger.warning(
+                f"The backfill of {self.guild.id} couldn't read {self.channels_failed} channels, leaving it to resume."
+            )
+            return False
+        await self.finish()
+        return True
+
+    async def scan_channel(self, channel_id, last_message_id):
+        channel = self.guild.get_channel(channel_id)
+        settings = self.cog.settings.get(self.guild.id) or make_settings(self.guild.id)
+        counts = Counter()
+        unsaved = 0
+        if channel:
+            try:
+                async for message in channel.history(
+                    limit=None,
+                    after=Object(last_message_id) if last_message_id else None,
+                    before=Object(self.boundary_id),
+                    oldest_first=True,
+                ):
+                    self.scanned += 1
+                    self.cog.backfill_scanned.inc()
+                    unsaved += 1
+                    last_message_id = message.id
+                    if self.cog.is_countable(message, settings):
+                        counts[message.author.id] += 1
+                        self.counted += 1
+                    if unsaved >= self.cog.init_checkpoint_every:
+                        await self.save(channel_id, last_message_id, counts, False)
+                        counts.clear()
+                        unsaved = 0
+            except (Forbidden, NotFound):
+                # The channel became unreadable midway, keep what was counted
+                self.bot.logger.warning(
+                    f"Stopped the backfill of channel {channel_id} in {self.guild.id} early."
+                )
+            except HTTPException:
+                # Probably transient, a resume continues after the checkpoint
+                self.channels_failed += 1
+                self.bot.logger.warning(
+                    f"Couldn't read channel {channel_id} in {self.guild.id}, leaving it to resume.",
+                    exc_info=True,
+                )
+                return await self.save(channel_id, last_message_id, counts, False)
+        await self.save(channel_id, last_message_id, counts, True)
+
+    async def save(self, channel_id, last_message_id, counts, done):
+        rows = [(self.guild.id, user_id, count) for user_id, count in counts.items()]
+        await self.bot.db.storage.save_checkpoint(
+            self.guild.id, channel_id, last_message_id, done, rows
+        )
+
+    async def report_progress(self):
+        if not self.progress_message:
+            return
+        while True:
+            await sleep(self.cog.init_progress_interval)
+            try:
+                await self.progress_message.edit(content=self.progress())
+            except HTTPException:
+                pass
+
+    async def finish(self):
+        await self.bot.db.storage.finish_backfill(self.guild.id)
+        async for user_id, message_count in self.bot.db.storage.iter_guild(
+            self.guild.id
+        ):
+            self.cog.roles.submit(self.guild.id, user_id, message_count)
+        self.bot.logger.info(
+            f"Backfilled {self.scanned} messages of {self.guild.id} in {round(perf_counter() - self.started)}s."
+        )
@@ -0,0 +1,68 @@
+from collections import Counter
+from sys import getsizeof
+
+
+class PendingCounts:
+    """Per-guild message tallies that haven't been written to the database yet.
+
+    The event loop runs one callback at a time, so adding to the buffer needs
+    no lock. The flush detaches the whole buffer by swapping in a fresh
+    instance and works on the detached one, so the hot path never waits on it.
+    """
+
+    __slots__ = ("guilds", "rows", "limit", "dropped")
+
+    def __init__(self, limit=None):
+        self.guilds = {}
+        self.rows = 0
+        self.limit = limit
+        self.dropped = 0
+
+    def __bool__(self):
+        return self.rows > 0
+
+    def add(self, guild_id, user_id, amount=1):
+        tally = self.guilds.get(guild_id)
+        if tally is None:
+            tally = self.guilds[guild_id] = Counter()
+        if user_id not in tally:
+            if self.limit and self.rows >= self.limit:
+                # Existing rows keep counting, new ones would grow the buffer
+                self.dropped += amount
+                return False
+            self.rows += 1
+        tally[user_id] += amount
+        return True
+
+    def get(self, guild_id, user_id):
+        tally = self.guilds.get(guild_id)
+        return tally[user_id] if tally else 0
+
+    def discard(self, guild_id):
+        """Forgets every count of a guild."""
+        tally = self.guilds.pop(guild_id, None)
+        if tally:
+            self.rows -= len(tally)
+
+    def merge(self, other):
+        """Adds another buffer's counts, used to requeue a failed flush."""
+        for guild_id, tally in other.guilds.items():
+            own = self.guilds.setdefault(guild_id, Counter())
+            before = len(own)
+            own.update(tally)
+            self.rows += len(own) - before
+
+    def items(self):
+        """Yields (guild_id, user_id, count) rows."""
+        for guild_id, tally in self.guilds.items():
+            for user_id, count in tally.items():
+                yield guild_id, user_id, count
+
+    def footprint(self):
+        """Approximate memory held by the buffer, in bytes."""
+        # Every row holds a user id key and a count value
+        return (
+            getsizeof(self.guilds)
+            + sum(getsizeof(tally) for tally in self.guilds.values())
+            + self.rows * 2 * getsizeof(2**62)
+        )
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from time import monotonic
+
+
+class CountCache:
+    """Least recently used cache of persisted (guild_id, user_id) counts.
+
+    Entries expire after ttl seconds and the least recently used ones are
+    evicted past maxsize, which caps the memory it holds. A count read from
+    the database is cached with fill(), which drops it when the cache was
+    written to during the read, e.g. by a flush with a newer count.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every write, a read started at an older version may be stale
+        self.version = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, guild_id, user_id, count):
+        self.version += 1
+        key = (guild_id, user_id)
+        self._entries[key] = (count, monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def add(self, guild_id, user_id, amount):
+        """Adds to a cached count, e.g. a flushed delta to a windowed count."""
+        self.version += 1
+        key = (guild_id, user_id)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = (entry[0] + amount, entry[1])
+
+    def fill(self, guild_id, user_id, count, version):
+        """Caches a count read since version and returns the newest count known.
+
+        Returns None when the cache was written to during the read but holds
+        no entry of the user, the read may have missed that write.
+        """
+        if version == self.version:
+            self.set(guild_id, user_id, count)
+            return count
+        entry = self._entries.get((guild_id, user_id))
+        if entry is not None and entry[1] >= monotonic():
+            # Written during the read, the get() before it missed
+            return entry[0]
+        return None
+
+    def invalidate_guild(self, guild_id):
+        self.version += 1
+        for key in [key for key in self._entries if key[0] == guild_id]:
+            del self._entries[key]
@@ -0,0 +1,150 @@
+from asyncio import gather
+from csv import DictWriter
+from gzip import GzipFile
+from io import TextIOWrapper
+from tempfile import SpooledTemporaryFile
+
+from discord.errors import HTTPException, NotFound
+from pytz import utc
+
+from .members import QUERY_LIMIT
+
+FIELDNAMES = ["user_id", "username", "joined_at", "message_count", "recent_messages"]
+# Room for rows written between two size checks and the still buffered gzip data
+PART_MARGIN = 256 * 1024
+SIZE_CHECK_EVERY = 500
+
+
+class CSVExport:
+    """Streams a guild's counts into one or more CSV files.
+
+    Rows are streamed from the storage and written into spooled temporary
+    files, so only a bounded amount stays in memory. Members that aren't
+    cached are requested in batches, users who left the guild are looked up
+    concurrently, and a new part is started whenever the current one would
+    outgrow the guild's upload limit.
+    """
+
+    def __init__(self, cog, guild, compress=False):
+        self.bot = cog.bot
+        self.guild = guild
+        self.compress = compress
+        self.part_size = max(guild.filesize_limit - PART_MARGIN, PART_MARGIN)
+        # Every part is kept until gencsv sends them, a spool as large as a
+        # part would never spill and hold the whole export in memory
+        self.spool_size = min(cog.export_spool_size, self.part_size // 4)
+        self.fetch_batch = cog.export_fetch_batch
+        self.members = cog.members
+        self.profiles = cog.profiles
+        self.activity_since = cog.activity_since()
+        # {user_id: messages} within the activity window, loaded by run()
+        self.recent = {}
+        self.parts = []
+        self._unresolved = []
+        self._rows = 0
+
+    def _open_part(self):
+        self._raw = SpooledTemporaryFile(max_size=self.spool_size)
+        self._gzip = GzipFile(fileobj=self._raw, mode="wb") if self.compress else None
+        self._text = TextIOWrapper(
+            self._gzip or self._raw, encoding="utf-8", newline=""
+        )
+        self._writer = DictWriter(self._text, fieldnames=FIELDNAMES)
+        self._writer.writeheader()
+
+    def _close_part(self):
+        self._text.flush()
+        self._text.detach()
+        if self._gzip:
+            self._gzip.close()
+        self._raw.seek(0)
+        self.parts.append(self._raw)
+
+    def _write(self, row):
+        self._writer.writerow(row)
+        self._rows += 1
+        if self._rows % SIZE_CHECK_EVERY:
+            return
+        self._text.flush()
+        if self._raw.tell() >= self.part_size:
+            self._close_part()
+            self._open_part()
+
+    async def _fetch_name(self, user_id):
+        try:
+            return str(await self.bot.fetch_user(user_id))
+        except NotFound:
+            return "Deleted User"
+        except HTTPException:
+            return ""
+
+    def _write_member(self, member, message_count):
+        self._write(
+            {
+                "user_id": member.id,
+                "username": member,
+                "joined_at": member.joined_at.astimezone(utc),
+                "message_count": message_count,
+                "recent_messages": self.recent.get(member.id, 0),
+            }
+        )
+
+    async def _resolve_unknown(self):
+        batch, self._unresolved = self._unresolved, []
+        members = await gather(
+            *(self.members.resolve(self.guild, user_id) for user_id, _ in batch)
+        )
+        departed = [
+            user_id for (user_id, _), member in zip(batch, members) if not member
+        ]
+        names = {
+            user_id: profile.name
+            for user_id, profile in (
+                await self.profiles.lookup(self.bot.db.storage, self.guild.id, departed)
+            ).items()
+        }
+        # Only users that were never seen since the profiles were introduced
+        unknown = [user_id for user_id in departed if user_id not in names]
+        for i in range(0, len(unknown), self.fetch_batch):
+            chunk = unknown[i : i + self.fetch_batch]
+            for user_id, name in zip(
+                chunk, await gather(*(self._fetch_name(user_id) for user_id in chunk))
+            ):
+                names[user_id] = name
+                if name:
+                    self.profiles.record(self.guild.id, user_id, name, False)
+        for (user_id, message_count), member in zip(batch, members):
+            if member:
+                self._write_member(member, message_count)
+                continue
+            self._write(
+                {
+                    "user_id": user_id,
+                    "username": names[user_id],
+                    "joined_at": "",
+                    "message_count": message_count,
+                    "recent_messages": self.recent.get(user_id, 0),
+                }
+            )
+
+    async def run(self):
+        """Writes the export and returns the finished parts, rewound."""
+        # Pre-aggregated, at most a few rows per active user
+        self.recent = await self.bot.db.storage.recent_activity(
+            self.guild.id, self.activity_since
+        )
+        self._open_part()
+        async for user_id, message_count in self.bot.db.storage.iter_guild(
+            self.guild.id, replica=True
+        ):
+            member = self.members.get(self.guild, user_id)
+            if not member:
+                self._unresolved.append((user_id, message_count))
+                if len(self._unresolved) >= QUERY_LIMIT:
+                    await self._resolve_unknown()
+                continue
+            self._write_member(member, message_count)
+        if self._unresolved:
+            await self._resolve_unknown()
+        self._close_part()
+        return self.parts
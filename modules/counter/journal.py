@@ -0,0 +1,93 @@
+from collections import Counter
+from os import listdir, makedirs, path, remove, rename
+from struct import Struct
+
+# One counted message: guild id, user id
+RECORD = Struct("<QQ")
+
+
+class Journal:
+    """Append-only local log of the counts that haven't been flushed yet.
+
+    Records are written unbuffered, so they reach the OS as soon as a message
+    is counted and survive the process being killed. Every flush seals the
+    current segment and starts a new one, sealed segments are removed once
+    the flush that covers them has been written to the database. Segments
+    left behind by a crash are replayed on startup. While a flush is failing
+    the segments aren't sealed again, the next one to succeed rewrites them
+    into one holding only what's still unflushed.
+    """
+
+    def __init__(self, directory):
+        makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sealed = sorted(
+            (
+                path.join(directory, name)
+                for name in listdir(directory)
+                if name.endswith(".journal")
+            ),
+            key=self._sequence_of,
+        )
+        self._sequence = self._sequence_of(self.sealed[-1]) + 1 if self.sealed else 0
+        self._file = None
+        self._open_segment()
+
+    @staticmethod
+    def _sequence_of(segment):
+        return int(path.basename(segment).split(".")[0])
+
+    def _open_segment(self):
+        self._path = path.join(self.directory, f"{self._sequence:012d}.journal")
+        self._sequence += 1
+        self._file = open(self._path, "ab", buffering=0)
+
+    def replay(self):
+        """Returns the counts stored in the sealed segments."""
+        counts = Counter()
+        for segment in self.sealed:
+            with open(segment, "rb") as f:
+                data = f.read()
+            # A crash can cut the last record short
+            data = data[: len(data) - len(data) % RECORD.size]
+            counts.update(RECORD.iter_unpack(data))
+        return counts
+
+    def append(self, guild_id, user_id):
+        self._file.write(RECORD.pack(guild_id, user_id))
+
+    def seal(self):
+        """Starts a new segment and returns every sealed one."""
+        self._file.close()
+        self.sealed.append(self._path)
+        self._open_segment()
+        return list(self.sealed)
+
+    def release(self, segments):
+        """Removes segments whose counts have been written to the database."""
+        for segment in segments:
+            self.sealed.remove(segment)
+            remove(segment)
+
+    def rewrite(self, rows):
+        """Replaces every segment with one holding the (guild_id, user_id, count) rows."""
+        self._file.close()
+        old = [*self.sealed, self._path]
+        self.sealed = []
+        self._open_segment()
+        self._file.close()
+        # Written aside first, a crash while writing keeps the old segments
+        with open(self._path + ".tmp", "wb") as f:
+            f.write(
+                b"".join(
+                    RECORD.pack(guild_id, user_id) * count
+                    for guild_id, user_id, count in rows
+                )
+            )
+        for segment in old:
+            remove(segment)
+        rename(self._path + ".tmp", self._path)
+        self._file = open(self._path, "ab", buffering=0)
+
+    def close(self):
+        self._file.close()
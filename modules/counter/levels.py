@@ -0,0 +1,52 @@
+from collections import namedtuple
+from datetime import datetime
+
+LevelRule = namedtuple("LevelRule", ["role", "messages", "days"])
+
+# Used for guilds without their own level rules in their settings
+DEFAULT_LEVEL_RULES = (
+    LevelRule("Level 1", 12, 0),
+    LevelRule("Level 2", 48, 43),
+    LevelRule("Level 3", 100, 85),
+)
+
+
+class LevelTable:
+    """A guild's level rules compiled against its current roles.
+
+    Rules are ordered from the lowest to the highest level, each one holding
+    its thresholds and the resolved role id. Tables are cached per guild and
+    have to be rebuilt whenever the guild's roles change.
+    """
+
+    __slots__ = ("messages", "days", "role_ids", "names", "level_role_ids")
+
+    def __init__(self, guild, rules):
+        rules = sorted((LevelRule(*rule) for rule in rules), key=lambda r: r[1:])
+        role_ids = {role.name: role.id for role in guild.roles}
+        self.messages = tuple(rule.messages for rule in rules)
+        self.days = tuple(rule.days for rule in rules)
+        self.names = tuple(rule.role for rule in rules)
+        self.role_ids = tuple(role_ids.get(rule.role) for rule in rules)
+        # Any role named like a level is swapped out on a level up
+        self.level_role_ids = frozenset(
+            role.id for role in guild.roles if "Level" in role.name
+        )
+
+    def target(self, member, message_count, now=None):
+        """Returns the index of the rule the member should be promoted to."""
+        if member.joined_at:
+            days = ((now or datetime.utcnow()) - member.joined_at).days
+        else:
+            days = 0
+        for index in range(len(self.messages) - 1, -1, -1):
+            if message_count >= self.messages[index] and days >= self.days[index]:
+                break
+        else:
+            return None
+        roles = member._roles
+        for role_id in self.role_ids[index:]:
+            if role_id and roles.has(role_id):
+                # Already on this level or above it
+                return None
+        return index
@@ -0,0 +1,96 @@
+from asyncio import shield
+from collections import OrderedDict
+
+# Most user ids the gateway accepts in one member request
+QUERY_LIMIT = 100
+
+
+class MemberResolver:
+    """Finds members when the member cache doesn't hold all of them.
+
+    In the low memory mode the gateway cache is turned off and only the
+    most recent message authors are kept here. Members that aren't found
+    are requested over the gateway, lookups for the same guild that come
+    in together are sent as one request.
+    """
+
+    def __init__(self, bot, maxsize, lazy, owner=None):
+        self.bot = bot
+        self.owner = owner
+        self.maxsize = maxsize
+        self.lazy = lazy
+        self.queried = 0
+        self._recent = OrderedDict()
+        # guild_id -> {user_id: future} waiting for the next member request
+        self._queued = {}
+
+    def __len__(self):
+        return len(self._recent)
+
+    def remember(self, member):
+        if not self.lazy:
+            return
+        key = (member.guild.id, member.id)
+        self._recent[key] = member
+        self._recent.move_to_end(key)
+        if len(self._recent) > self.maxsize:
+            self._recent.popitem(last=False)
+
+    def forget_guild(self, guild_id):
+        for key in [key for key in self._recent if key[0] == guild_id]:
+            del self._recent[key]
+
+    def get(self, guild, user_id):
+        """Returns a cached member without asking Discord."""
+        member = guild.get_member(user_id)
+        if member or not self.lazy:
+            return member
+        member = self._recent.get((guild.id, user_id))
+        if member:
+            self._recent.move_to_end((guild.id, user_id))
+        return member
+
+    async def resolve(self, guild, user_id):
+        """Returns the member, or None when the user isn't on the guild."""
+        member = self.get(guild, user_id)
+        if member or not self.lazy:
+            return member
+        queued = self._queued.get(guild.id)
+        first = queued is None
+        if first:
+            queued = self._queued[guild.id] = {}
+        future = queued.get(user_id)
+        if future is None:
+            future = queued[user_id] = self.bot.loop.create_future()
+        if first:
+            # Runs after the lookups that are already scheduled have queued up,
+            # while it waits for room more lookups join the same request. They
+            # wait for it too, so it goes ahead if this lookup is cancelled.
+            await shield(
+                self.bot.tasks.submit(
+                    "member-requests", self._query(guild), owner=self.owner
+                )
+            )
+        return await future
+
+    async def _query(self, guild):
+        queued = self._queued.pop(guild.id)
+        user_ids = list(queued)
+        for i in range(0, len(user_ids), QUERY_LIMIT):
+            batch = user_ids[i : i + QUERY_LIMIT]
+            self.queried += len(batch)
+            try:
+                members = await guild.query_members(
+                    user_ids=batch, limit=len(batch), cache=False
+                )
+            except Exception:
+                self.bot.logger.exception(
+                    f"Couldn't request {len(batch)} members of {guild.id}."
+                )
+                members = []
+            # Not remembered, a backfill or an export would push out the
+            # recent authors
+            found = {member.id: member for member in members}
+            for user_id in batch:
+                if not queued[user_id].done():
+                    queued[user_id].set_result(found.get(user_id))
@@ -0,0 +1,101 @@
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+Profile = namedtuple("Profile", ["name", "is_member", "refreshed_at"])
+
+
+class ProfileCache:
+    """Users' names and guild membership, in front of the user_profile table.
+
+    What the gateway shows is collected here and written in one batch per
+    count flush. A profile that didn't change is only written again once
+    it's older than refresh_after, so on_message rarely adds to a batch.
+    Lookups read the table on a miss without filling the cache, an export
+    would push out the recent authors.
+    """
+
+    def __init__(self, maxsize, refresh_after):
+        self.maxsize = maxsize
+        self.refresh_after = refresh_after
+        self._entries = OrderedDict()
+        # (guild_id, user_id) -> Profile waiting for the next flush
+        self._pending = {}
+        # user_id -> (name, refreshed_at) of every guild's profile of the user
+        self._renames = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def pending(self):
+        return len(self._pending) + len(self._renames)
+
+    def _set(self, key, profile):
+        self._entries[key] = profile
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def record(self, guild_id, user_id, name, is_member, now=None):
+        key = (guild_id, user_id)
+        now = now or datetime.now(timezone.utc)
+        entry = self._entries.get(key)
+        if (
+            entry
+            and entry.name == name
+            and entry.is_member == is_member
+            and now - entry.refreshed_at < self.refresh_after
+        ):
+            self._entries.move_to_end(key)
+            return
+        profile = Profile(name, is_member, now)
+        self._set(key, profile)
+        self._pending[key] = profile
+
+    def seen(self, guild_id, user, is_member=True):
+        self.record(guild_id, user.id, str(user), is_member)
+
+    def renamed(self, user_id, name, guild_ids):
+        """Renames the user's profiles, guild_ids are where it may be cached."""
+        now = datetime.now(timezone.utc)
+        self._renames[user_id] = (name, now)
+        for guild_id in guild_ids:
+            entry = self._entries.get((guild_id, user_id))
+            if entry:
+                self._entries[guild_id, user_id] = entry._replace(
+                    name=name, refreshed_at=now
+                )
+
+    async def lookup(self, storage, guild_id, user_ids):
+        """Returns {user_id: Profile} of the users that have a profile."""
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            entry = self._entries.get((guild_id, user_id))
+            if entry:
+                found[user_id] = entry
+            else:
+                missing.append(user_id)
+        if missing:
+            for user_id, *profile in await storage.get_profiles(guild_id, missing):
+                found[user_id] = Profile(*profile)
+        return found
+
+    async def flush(self, storage):
+        """Writes the collected changes, they're kept for a retry if that fails."""
+        if not self._pending and not self._renames:
+            return
+        profiles, self._pending = self._pending, {}
+        renames, self._renames = self._renames, {}
+        try:
+            await storage.save_profiles(
+                [(*key, *profile) for key, profile in profiles.items()],
+                [(user_id, *rename) for user_id, rename in renames.items()],
+            )
+        except BaseException:
+            # Changes collected meanwhile are newer
+            for key, profile in profiles.items():
+                self._pending.setdefault(key, profile)
+            for user_id, rename in renames.items():
+                self._renames.setdefault(user_id, rename)
+            raise
@@ -0,0 +1,45 @@
+from sortedcontainers import SortedList
+
+
+class GuildRanking:
+    """A guild's users ordered by message count, highest first.
+
+    Loaded once from the database and kept up to date with the rows every
+    flush returns, so pages are served without touching the database. The
+    SortedList keeps an update logarithmic, a flush on a large guild would
+    otherwise shift the whole list for every row.
+    """
+
+    __slots__ = ("counts", "order")
+
+    def __init__(self, rows):
+        self.counts = dict(rows)
+        # Negated counts sort the highest first, ties by user id
+        self.order = SortedList(
+            (-count, user_id) for user_id, count in self.counts.items()
+        )
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, user_id, count):
+        old = self.counts.get(user_id)
+        if old is not None:
+            self.order.remove((-old, user_id))
+        self.counts[user_id] = count
+        self.order.add((-count, user_id))
+
+    def page(self, start, size):
+        """Returns (rank, user_id, count) entries starting at rank start + 1."""
+        return [
+            (rank, user_id, -count)
+            for rank, (count, user_id) in enumerate(
+                self.order.islice(start, start + size), start=start + 1
+            )
+        ]
+
+    def rank(self, user_id):
+        count = self.counts.get(user_id)
+        if count is None:
+            return None
+        return self.order.index((-count, user_id)) + 1
@@ -0,0 +1,167 @@
+from asyncio import Event, gather
+from collections import deque
+from itertools import islice
+from time import monotonic
+
+from discord import Object
+from discord.errors import Forbidden, HTTPException
+from discord.utils import get as discord_get
+
+from .members import QUERY_LIMIT
+
+# Seconds between two missing permission reports in a guild's bot-log
+REPORT_INTERVAL = 3600.0
+
+
+class RoleReconciler:
+    """Brings members' level roles in line with their counts.
+
+    Changes are queued per guild, a member queued again before it was
+    handled only keeps the newest count. A fixed number of workers takes
+    batches from the guilds in turn, so one big guild can't hold up the
+    others, and the number of concurrent role edits stays bounded.
+    """
+
+    def __init__(self, cog, workers):
+        self.cog = cog
+        self.bot = cog.bot
+        # guild_id -> {user_id: message_count} waiting to be reconciled
+        self.pending = {}
+        # Guilds with pending members, in the order they get their turn
+        self.turns = deque()
+        self.size = 0
+        self.active = 0
+        self._wakeup = Event()
+        self._idle = Event()
+        self._idle.set()
+        self._reported = {}
+        updates = self.bot.metrics.counter(
+            "postnrole_role_updates_total",
+            "Members handled by the level role reconciler",
+            ["result"],
+        )
+        self.updated = updates.labels("updated")
+        self.unchanged = updates.labels("unchanged")
+        self.failed = updates.labels("failed")
+        for _ in range(workers):
+            self.bot.tasks.spawn("roles", self.work(), owner=cog)
+
+    def __len__(self):
+        return self.size
+
+    def submit(self, guild_id, user_id, message_count):
+        members = self.pending.get(guild_id)
+        if members is None:
+            members = self.pending[guild_id] = {}
+            self.turns.append(guild_id)
+        if user_id not in members:
+            self.size += 1
+        members[user_id] = max(message_count, members.get(user_id, 0))
+        self._idle.clear()
+        self._wakeup.set()
+
+    def discard(self, guild_id):
+        members = self.pending.pop(guild_id, None)
+        if members:
+            self.size -= len(members)
+            self.turns.remove(guild_id)
+
+    def _take(self):
+        """Takes a batch of the guild whose turn it is."""
+        guild_id = self.turns.popleft()
+        members = self.pending[guild_id]
+        batch = list(islice(members.items(), QUERY_LIMIT))
+        for user_id, _ in batch:
+            del members[user_id]
+        self.size -= len(batch)
+        if members:
+            self.turns.append(guild_id)
+        else:
+            del self.pending[guild_id]
+        return guild_id, batch
+
+    async def work(self):
+        while True:
+            if not self.turns:
+                if not self.active:
+                    self._idle.set()
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            guild_id, batch = self._take()
+            self.active += 1
+            try:
+                await self.reconcile(guild_id, batch)
+            except Exception:
+                self.bot.logger.exception(f"Couldn't reconcile roles in {guild_id}.")
+            finally:
+                self.active -= 1
+
+    async def join(self):
+        """Waits until everything submitted so far has been handled."""
+        await self._idle.wait()
+
+    async def reconcile(self, guild_id, batch):
+        guild = self.bot.get_guild(guild_id)
+        if not guild:
+            return
+        table = self.cog.level_table(guild)
+        # Lookups of a batch go out as one member request
+        members = await gather(
+            *(self.cog.members.resolve(guild, user_id) for user_id, _ in batch)
+        )
+        for member, (_, message_count) in zip(members, batch):
+            if not member:
+                continue
+            index = table.target(member, message_count)
+            if index is None:
+                self.unchanged.inc()
+                continue
+            await self.apply(table, member, index)
+
+    async def apply(self, table, member, index):
+        name = table.names[index]
+        role_id = table.role_ids[index]
+        if not role_id:
+            self.failed.inc()
+            return self.bot.logger.warning(
+                f"Couldn't level up member {member.id}, {member.guild.id} has no role named {name}."
+            )
+        try:
+            if member.guild.get_member(member.id) is member:
+                # The gateway keeps cached members' roles current, so the
+                # whole role list can be replaced in one request
+                roles = [
+                    Object(id) for id in member._roles if id not in table.level_role_ids
+                ]
+                await member.edit(
+                    roles=[*roles, Object(role_id)], reason="Auto levelup role"
+                )
+            else:
+                # The roles of a requested or recent member may be outdated,
+                # replacing all of them could undo someone else's change
+                level_roles = [
+                    Object(id) for id in member._roles if id in table.level_role_ids
+                ]
+                if level_roles:
+                    await member.remove_roles(*level_roles, reason="Auto levelup role")
+                await member.add_roles(Object(role_id), reason="Auto levelup role")
+        except Forbidden:
+            self.failed.inc()
+            await self.report_forbidden(member, name)
+        except HTTPException:
+            self.failed.inc()
+            self.bot.logger.exception(f"Couldn't level up member {member.id}.")
+        else:
+            self.updated.inc()
+
+    async def report_forbidden(self, member, name):
+        reported_at = self._reported.get(member.guild.id)
+        if reported_at and monotonic() - reported_at < REPORT_INTERVAL:
+            return
+        self._reported[member.guild.id] = monotonic()
+        bot_log = discord_get(member.guild.text_channels, name="bot-log")
+        if bot_log:
+            await bot_log.send(
+                f"Couldn't level up member `{member}` due to missing permissions to {name}"
+            )
@@ -0,0 +1,89 @@
+from collections import namedtuple
+
+from .levels import LevelRule
+
+GuildSettings = namedtuple(
+    "GuildSettings",
+    ["guild_id", "enabled", "min_words", "excluded_channels", "level_rules"],
+)
+# Matches the hard coded filter from before the settings table
+DEFAULT_MIN_WORDS = 3
+
+
+def make_settings(
+    guild_id,
+    enabled=True,
+    min_words=DEFAULT_MIN_WORDS,
+    excluded_channels=(),
+    level_rules=None,
+):
+    """Builds settings from a storage row, level_rules None means the defaults."""
+    return GuildSettings(
+        guild_id,
+        enabled,
+        min_words,
+        frozenset(excluded_channels),
+        tuple(LevelRule(*rule) for rule in level_rules) if level_rules else None,
+    )
+
+
+class SettingsRegistry:
+    """Every guild's settings, keyed by guild id.
+
+    Entries are immutable tuples, an update replaces the guild's entry, so
+    a reader never sees a half applied change. Guilds without an entry
+    aren't counted.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage
+        self._guilds = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Settings of config.counted_guilds, used until the table is loaded."""
+        registry = cls()
+        level_rules = getattr(config, "level_rules", {})
+        for guild_id in config.counted_guilds:
+            registry._guilds[guild_id] = make_settings(
+                guild_id, level_rules=level_rules.get(guild_id)
+            )
+        return registry
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def get(self, guild_id):
+        return self._guilds.get(guild_id)
+
+    def is_counted(self, guild_id):
+        settings = self._guilds.get(guild_id)
+        return settings is not None and settings.enabled
+
+    async def load(self, storage):
+        """Replaces the entries with the table's, seeding an empty table from them."""
+        self.storage = storage
+        rows = await storage.list_guild_settings()
+        if not rows and self._guilds:
+            for settings in self._guilds.values():
+                await storage.save_guild_settings(*settings)
+            return
+        self._guilds = {row[0]: make_settings(*row) for row in rows}
+
+    async def reload(self, guild_id):
+        """Reads one guild's entry again, after another process changed it."""
+        row = await self.storage.get_guild_settings(guild_id)
+        if row:
+            self._guilds[guild_id] = make_settings(*row)
+        else:
+            self._guilds.pop(guild_id, None)
+
+    async def update(self, guild_id, **changes):
+        """Stores the changed fields and returns the guild's new settings."""
+        settings = self._guilds.get(guild_id) or make_settings(guild_id)
+        if "excluded_channels" in changes:
+            changes["excluded_channels"] = frozenset(changes["excluded_channels"])
+        settings = settings._replace(**changes)
+        await self.storage.save_guild_settings(*settings)
+        self._guilds[guild_id] = settings
+        return settings
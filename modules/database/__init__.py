@@ -1,64 +1,118 @@
-from asyncio import TimeoutError, sleep, wait_for
-from traceback import format_exc
+from asyncio import TimeoutError, wait_for
+from importlib.util import find_spec
 
 from discord.ext import commands
 
+from .sqlite import SQLiteStorage
+from .storage import PostgresStorage
+
+# Ready once connected and migrated, see loader.py
+SIGNALS_READY = True
+
 
 class Database(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.pool = None
+        self.storage = None
         bot.db = self
         self.is_ready = False
-        bot.loop.create_task(self.connect_db())
+        self.acquire_wait = bot.metrics.histogram(
+            "postnrole_db_acquire_wait_seconds",
+            "Time spent waiting for a pool connection",
+            ["pool"],
+        )
+        self.statement_latency = bot.metrics.histogram(
+            "postnrole_db_statement_seconds",
+            "Time taken by database statements",
+            ["statement"],
+        )
+        bot.metrics.gauge(
+            "postnrole_db_pool_size",
+            "Open connections in the database pool",
+            lambda: self.pool.get_size(),
+        )
+        bot.metrics.gauge(
+            "postnrole_db_pool_idle",
+            "Idle connections in the database pool",
+            lambda: self.pool.get_idle_size(),
+        )
+        bot.metrics.gauge(
+            "postnrole_db_replica_pool_size",
+            "Open connections in the read replica pool",
+            lambda: self.storage.replica.get_size(),
+        )
+        bot.metrics.gauge(
+            "postnrole_db_replica_pool_idle",
+            "Idle connections in the read replica pool",
+            lambda: self.storage.replica.get_idle_size(),
+        )
+        bot.tasks.spawn("startup", self.connect_db(), owner=self)
+
+    @property
+    def pool(self):
+        """The asyncpg pool, None when running on SQLite."""
+        return getattr(self.storage, "pool", None)
 
     async def connect_db(self):
-        try:
-            from asyncpg import create_pool
-        except (ImportError, ModuleNotFoundError):
-            self.bot.logger.error(
-                "The asyncpg database driver is not installed, db functions will be disabled."
+        backend = getattr(self.bot.config, "db_backend", "postgres")
+        if backend == "sqlite":
+            self.storage = SQLiteStorage(
+                getattr(self.bot.config, "sqlite_path", "postnrole.db"),
+                self.bot.logger,
             )
-            del self.bot.db
-            self.bot.unload_extension(self.__class__.__module__)
-        try:
-            self.pool = await create_pool(
-                **self.bot.config.db_creds,
-                min_size=10,
-                max_size=20,
-                timeout=10.0,
-                command_timeout=60.0
+        else:
+            if find_spec("asyncpg") is None:
+                self.bot.logger.error(
+                    "The asyncpg database driver is not installed, db functions will be disabled."
+                )
+                del self.bot.db
+                self.bot.loader.set_failed("database")
+                return self.bot.unload_extension(self.__class__.__module__)
+            self.storage = PostgresStorage(
+                self.bot.config.db_creds,
+                getattr(self.bot.config, "flush_batch_size", 5000),
+                self.acquire_wait,
+                self.statement_latency,
+                self.bot.logger,
+                getattr(self.bot.config, "db_replica_creds", None),
+                getattr(self.bot.config, "db_pool_size", (10, 20)),
+                getattr(self.bot.config, "db_replica_pool_size", (2, 10)),
             )
+        try:
+            await self.storage.connect()
         except:
-            self.bot.logger.error("Couldn't connect to database.")
-            format_exc()
+            self.bot.logger.exception("Couldn't connect to database.")
             del self.bot.db
+            self.bot.loader.set_failed("database")
             self.bot.unload_extension(self.__class__.__module__)
         else:
-            await self.initialize_db()
+            self.is_ready = True
+            self.bot.loader.set_ready("database")
 
     async def shutdown_db(self):
-        async def _close_db():
-            if self.pool and self.pool._initialized and not self.pool._closed:
-                await self.pool.close()
-
         try:
-            await wait_for(_close_db(), timeout=3.0)
-        except TimeoutError:
-            self.pool.terminate()
-            del self.bot.db
-            self.bot.logger.info("Database pool gracefully shut down.")
-
-    async def initialize_db(self):
-        if not await self.pool.fetchval("SELECT to_regclass('public.message_count')"):
-            await self.pool.execute(
-                "CREATE TABLE message_count ( user_id bigint NOT NULL, guild_id bigint NOT NULL, message_count decimal NOT NULL )"
+            # Modules that were unloaded with it write out what they still hold
+            await wait_for(
+                self.bot.tasks.join("drain"),
+                getattr(self.bot.config, "shutdown_deadline", 10.0),
             )
-        self.is_ready = True
+        except TimeoutError:
+            self.bot.logger.warning("Closing the database before every module drained.")
+        try:
+            await wait_for(self.storage.close(), timeout=3.0)
+        except TimeoutError:
+            if self.pool:
+                self.pool.terminate()
+        self.bot.logger.info("Database gracefully shut down.")
 
     def cog_unload(self):
+        self.bot.tasks.cancel_owner(self)
         self.is_ready = False
-        self.bot.loop.create_task(self.shutdown_db())
+        # Dependents loaded from now on wait for the next connection
+        self.bot.loader.reset("database")
+        if self.storage:
+            # Not owned by the cog, it has to outlive the unload
+            self.bot.tasks.spawn("shutdown", self.shutdown_db())
 
 
 def setup(bot):
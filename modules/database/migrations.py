@@ -0,0 +1,108 @@
+"""Numbered schema migrations, applied in order by the Database cog on startup.
+
+Append new migrations to the end of MIGRATIONS, never edit or reorder
+already released ones. Each migration runs in its own transaction together
+with its schema_version row.
+"""
+
+# Arbitrary key, keeps concurrently starting bots from migrating at once
+MIGRATION_LOCK = 0x506F73746E526F6C
+
+MIGRATIONS = (
+    (
+        1,
+        "create message_count",
+        (
+            "CREATE TABLE IF NOT EXISTS message_count ( user_id bigint NOT NULL, guild_id bigint NOT NULL, message_count decimal NOT NULL )",
+        ),
+    ),
+    (
+        2,
+        "key message_count on (guild_id, user_id)",
+        (
+            # Duplicates are merged into one row with their counts summed
+            "CREATE TEMPORARY TABLE message_count_merged ON COMMIT DROP AS SELECT guild_id, user_id, sum(message_count) AS message_count FROM message_count GROUP BY guild_id, user_id HAVING count(*) > 1",
+            "DELETE FROM message_count m USING message_count_merged d WHERE m.guild_id = d.guild_id AND m.user_id = d.user_id",
+            "INSERT INTO message_count (user_id, guild_id, message_count) SELECT user_id, guild_id, message_count FROM message_count_merged",
+            "ALTER TABLE message_count ADD PRIMARY KEY (guild_id, user_id)",
+            "DROP INDEX IF EXISTS message_count_guild_user",
+        ),
+    ),
+    (
+        3,
+        "store message counts as bigint",
+        ("ALTER TABLE message_count ALTER COLUMN message_count TYPE bigint",),
+    ),
+    (
+        4,
+        "index message_count by guild",
+        (
+            # The primary key already covers plain guild_id scans, carrying the
+            # count lets gencsv and rankings read the index only
+            "CREATE INDEX IF NOT EXISTS message_count_guild ON message_count (guild_id, message_count DESC)",
+        ),
+    ),
+    (
+        5,
+        "track resumable history backfills",
+        (
+            "CREATE TABLE init_state ( guild_id bigint PRIMARY KEY, boundary_id bigint NOT NULL, channel_id bigint, message_id bigint, started_at timestamptz NOT NULL DEFAULT now() )",
+            "CREATE TABLE init_checkpoint ( guild_id bigint NOT NULL, channel_id bigint NOT NULL, last_message_id bigint, done boolean NOT NULL DEFAULT false, PRIMARY KEY (guild_id, channel_id) )",
+        ),
+    ),
+    (
+        6,
+        "store per guild settings",
+        (
+            "CREATE TABLE guild_settings ( guild_id bigint PRIMARY KEY, enabled boolean NOT NULL DEFAULT true, min_words integer NOT NULL DEFAULT 3, excluded_channels bigint[] NOT NULL DEFAULT '{}', level_rules jsonb )",
+        ),
+    ),
+    (
+        7,
+        "track hourly and daily activity",
+        (
+            # One partition per day is created ahead by the rollup, which
+            # drops it once its hours are compacted into activity_daily
+            "CREATE TABLE activity_hourly ( guild_id bigint NOT NULL, user_id bigint NOT NULL, hour timestamptz NOT NULL, messages integer NOT NULL, PRIMARY KEY (guild_id, user_id, hour) ) PARTITION BY RANGE (hour)",
+            "CREATE TABLE activity_hourly_default PARTITION OF activity_hourly DEFAULT",
+            "CREATE TABLE activity_daily ( guild_id bigint NOT NULL, day date NOT NULL, user_id bigint NOT NULL, messages integer NOT NULL, PRIMARY KEY (guild_id, day, user_id) )",
+        ),
+    ),
+    (
+        8,
+        "keep user profiles",
+        (
+            "CREATE TABLE user_profile ( guild_id bigint NOT NULL, user_id bigint NOT NULL, name text NOT NULL, is_member boolean NOT NULL, refreshed_at timestamptz NOT NULL, PRIMARY KEY (guild_id, user_id) )",
+            # Renames and the background refresh look users up across guilds
+            "CREATE INDEX user_profile_user ON user_profile (user_id)",
+            "CREATE INDEX user_profile_refreshed ON user_profile (refreshed_at)",
+        ),
+    ),
+)
+
+
+async def migrate(pool, logger):
+    """Applies every migration newer than the stored schema version."""
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK)
+        try:
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_version ( version integer PRIMARY KEY, name text NOT NULL, applied_at timestamptz NOT NULL DEFAULT now() )"
+            )
+            current = await conn.fetchval(
+                "SELECT coalesce(max(version), 0) FROM schema_version"
+            )
+            for version, name, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                async with conn.transaction():
+                    for statement in statements:
+                        await conn.execute(statement)
+                    await conn.execute(
+                        "INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+                        version,
+                        name,
+                    )
+                logger.info(f"Applied database migration {version}: {name}")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK)
@@ -0,0 +1,367 @@
+import json
+import sqlite3
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from .storage import Storage, day_start
+
+# Applied in order, PRAGMA user_version holds the number of applied ones
+SQLITE_MIGRATIONS = (
+    (
+        "CREATE TABLE message_count ( guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, message_count INTEGER NOT NULL, PRIMARY KEY (guild_id, user_id) ) WITHOUT ROWID",
+        "CREATE INDEX message_count_guild ON message_count (guild_id, message_count DESC)",
+    ),
+    (
+        "CREATE TABLE init_state ( guild_id INTEGER PRIMARY KEY, boundary_id INTEGER NOT NULL, channel_id INTEGER, message_id INTEGER, started_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP )",
+        "CREATE TABLE init_checkpoint ( guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, last_message_id INTEGER, done INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (guild_id, channel_id) )",
+    ),
+    (
+        # Lists are stored as JSON
+        "CREATE TABLE guild_settings ( guild_id INTEGER PRIMARY KEY, enabled INTEGER NOT NULL DEFAULT 1, min_words INTEGER NOT NULL DEFAULT 3, excluded_channels TEXT NOT NULL DEFAULT '[]', level_rules TEXT )",
+    ),
+    (
+        # Hours and days are unix timestamps of their start
+        "CREATE TABLE activity_hourly ( guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, hour INTEGER NOT NULL, messages INTEGER NOT NULL, PRIMARY KEY (guild_id, user_id, hour) ) WITHOUT ROWID",
+        "CREATE TABLE activity_daily ( guild_id INTEGER NOT NULL, day INTEGER NOT NULL, user_id INTEGER NOT NULL, messages INTEGER NOT NULL, PRIMARY KEY (guild_id, day, user_id) ) WITHOUT ROWID",
+    ),
+    (
+        # refreshed_at is a unix timestamp
+        "CREATE TABLE user_profile ( guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, name TEXT NOT NULL, is_member INTEGER NOT NULL, refreshed_at INTEGER NOT NULL, PRIMARY KEY (guild_id, user_id) ) WITHOUT ROWID",
+        "CREATE INDEX user_profile_user ON user_profile (user_id)",
+        "CREATE INDEX user_profile_refreshed ON user_profile (refreshed_at)",
+    ),
+)
+ADD_COUNT = """
+INSERT INTO message_count (guild_id, user_id, message_count) VALUES (?, ?, ?)
+ON CONFLICT (guild_id, user_id) DO UPDATE
+SET message_count = message_count + excluded.message_count
+"""
+UPSERT_COUNT = ADD_COUNT + "RETURNING guild_id, user_id, message_count"
+ADD_ACTIVITY = """
+INSERT INTO activity_hourly (guild_id, user_id, messages, hour) VALUES (?, ?, ?, ?)
+ON CONFLICT (guild_id, user_id, hour) DO UPDATE
+SET messages = messages + excluded.messages
+"""
+ROLLUP_HOURLY = """
+INSERT INTO activity_daily (guild_id, day, user_id, messages)
+SELECT guild_id, hour - hour % 86400, user_id, sum(messages)
+FROM activity_hourly WHERE hour < ?
+GROUP BY 1, 2, 3
+ON CONFLICT (guild_id, day, user_id) DO UPDATE
+SET messages = messages + excluded.messages
+"""
+RECENT_ACTIVITY = """
+SELECT user_id, sum(messages) FROM (
+    SELECT user_id, messages FROM activity_daily WHERE guild_id=:guild_id AND day >= :day
+    UNION ALL
+    SELECT user_id, messages FROM activity_hourly WHERE guild_id=:guild_id AND hour >= :since
+) GROUP BY user_id
+"""
+USER_ACTIVITY = """
+SELECT coalesce(sum(messages), 0) FROM (
+    SELECT messages FROM activity_daily WHERE guild_id=:guild_id AND user_id=:user_id AND day >= :day
+    UNION ALL
+    SELECT messages FROM activity_hourly WHERE guild_id=:guild_id AND user_id=:user_id AND hour >= :since
+)
+"""
+SAVE_CHECKPOINT = """
+INSERT INTO init_checkpoint (guild_id, channel_id, last_message_id, done) VALUES (?, ?, ?, ?)
+ON CONFLICT (guild_id, channel_id) DO UPDATE
+SET last_message_id = excluded.last_message_id, done = excluded.done
+"""
+SELECT_SETTINGS = "SELECT guild_id, enabled, min_words, excluded_channels, level_rules FROM guild_settings"
+
+
+def _settings_row(row):
+    guild_id, enabled, min_words, excluded_channels, level_rules = row
+    return (
+        guild_id,
+        bool(enabled),
+        min_words,
+        json.loads(excluded_channels),
+        json.loads(level_rules) if level_rules else None,
+    )
+
+
+class SQLiteStorage(Storage):
+    """Embedded storage in a local SQLite database in WAL mode.
+
+    All queries run on one dedicated thread that owns the connection, so
+    they never block the event loop. Needs SQLite 3.35 or newer for
+    RETURNING.
+    """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def _run(self, function, *args):
+        return await get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _transaction(self, function, *args):
+        self.conn.execute("BEGIN")
+        try:
+            result = function(*args)
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return result
+
+    def _connect(self):
+        self.conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        current = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, statements in enumerate(SQLITE_MIGRATIONS, start=1):
+            if version <= current:
+                continue
+
+            def _apply():
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version={version}")
+
+            self._transaction(_apply)
+            self.logger.info(f"Applied SQLite migration {version}")
+
+    async def connect(self):
+        await self._run(self._connect)
+
+    async def close(self):
+        if self.conn:
+            await self._run(self.conn.close)
+        self._executor.shutdown(wait=False)
+
+    def _upsert(self, rows, hour=None):
+        results = [self.conn.execute(UPSERT_COUNT, row).fetchone() for row in rows]
+        if hour:
+            timestamp = int(hour.timestamp())
+            self.conn.executemany(ADD_ACTIVITY, [(*row, timestamp) for row in rows])
+        return results
+
+    async def upsert_counts(self, rows, hour=None):
+        return await self._run(self._transaction, self._upsert, rows, hour)
+
+    def _window(self, since):
+        # Whole days overlapping the window, like date truncation in Postgres
+        return {
+            "since": int(since.timestamp()),
+            "day": int(day_start(since.date()).timestamp()),
+        }
+
+    async def recent_activity(self, guild_id, since):
+        return dict(
+            await self._run(
+                lambda: self.conn.execute(
+                    RECENT_ACTIVITY, {"guild_id": guild_id, **self._window(since)}
+                ).fetchall()
+            )
+        )
+
+    async def user_activity(self, guild_id, user_id, since):
+        return await self._run(
+            lambda: self.conn.execute(
+                USER_ACTIVITY,
+                {"guild_id": guild_id, "user_id": user_id, **self._window(since)},
+            ).fetchone()[0]
+        )
+
+    async def rollup_activity(self, now, hourly_days, retention_days):
+        today = now.date()
+        cutoff = int(day_start(today - timedelta(days=hourly_days)).timestamp())
+        oldest = int(day_start(today - timedelta(days=retention_days)).timestamp())
+
+        def _rollup():
+            self.conn.execute(ROLLUP_HOURLY, (cutoff,))
+            self.conn.execute("DELETE FROM activity_hourly WHERE hour < ?", (cutoff,))
+            self.conn.execute("DELETE FROM activity_daily WHERE day < ?", (oldest,))
+
+        await self._run(self._transaction, _rollup)
+
+    async def ping(self):
+        # Includes the wait for the queries queued ahead on the thread
+        await self._run(lambda: self.conn.execute("SELECT 1").fetchone())
+
+    async def get_count(self, guild_id, user_id):
+        def _get():
+            row = self.conn.execute(
+                "SELECT message_count FROM message_count WHERE guild_id=? AND user_id=?",
+                (guild_id, user_id),
+            ).fetchone()
+            return row[0] if row else None
+
+        return await self._run(_get)
+
+    async def iter_guild(self, guild_id, replica=False):
+        # Keyset pages keep the shared connection free between pages
+        last_user_id = -1
+        while True:
+            rows = await self._run(
+                lambda: self.conn.execute(
+                    "SELECT user_id, message_count FROM message_count WHERE guild_id=? AND user_id>? ORDER BY user_id LIMIT 1000",
+                    (guild_id, last_user_id),
+                ).fetchall()
+            )
+            for row in rows:
+                yield row
+            if len(rows) < 1000:
+                return
+            last_user_id = rows[-1][0]
+
+    async def top_counts(self, guild_id, limit, offset=0):
+        return await self._run(
+            lambda: self.conn.execute(
+                "SELECT user_id, message_count FROM message_count WHERE guild_id=? ORDER BY message_count DESC, user_id LIMIT ? OFFSET ?",
+                (guild_id, limit, offset),
+            ).fetchall()
+        )
+
+    async def start_backfill(
+        self, guild_id, boundary_id, channel_id, message_id, channel_ids
+    ):
+        def _start():
+            self.conn.execute("DELETE FROM message_count WHERE guild_id=?", (guild_id,))
+            self.conn.execute(
+                "DELETE FROM init_checkpoint WHERE guild_id=?", (guild_id,)
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO init_state (guild_id, boundary_id, channel_id, message_id) VALUES (?, ?, ?, ?)",
+                (guild_id, boundary_id, channel_id, message_id),
+            )
+            self.conn.executemany(
+                SAVE_CHECKPOINT,
+                [(guild_id, channel_id, None, False) for channel_id in channel_ids],
+            )
+
+        await self._run(self._transaction, _start)
+
+    async def get_backfill(self, guild_id):
+        def _get():
+            row = self.conn.execute(
+                "SELECT boundary_id FROM init_state WHERE guild_id=?", (guild_id,)
+            ).fetchone()
+            return row[0] if row else None
+
+        return await self._run(_get)
+
+    async def list_backfills(self):
+        return await self._run(
+            lambda: self.conn.execute(
+                "SELECT guild_id, boundary_id, channel_id, message_id FROM init_state"
+            ).fetchall()
+        )
+
+    async def backfill_checkpoints(self, guild_id):
+        checkpoints = await self._run(
+            lambda: self.conn.execute(
+                "SELECT channel_id, last_message_id, done FROM init_checkpoint WHERE guild_id=?",
+                (guild_id,),
+            ).fetchall()
+        )
+        return len(checkpoints), [
+            (channel_id, last_message_id)
+            for channel_id, last_message_id, done in checkpoints
+            if not done
+        ]
+
+    async def save_checkpoint(self, guild_id, channel_id, last_message_id, done, rows):
+        def _save():
+            self.conn.executemany(ADD_COUNT, rows)
+            self.conn.execute(
+                SAVE_CHECKPOINT, (guild_id, channel_id, last_message_id, done)
+            )
+
+        await self._run(self._transaction, _save)
+
+    async def finish_backfill(self, guild_id):
+        def _finish():
+            self.conn.execute(
+                "DELETE FROM init_checkpoint WHERE guild_id=?", (guild_id,)
+            )
+            self.conn.execute("DELETE FROM init_state WHERE guild_id=?", (guild_id,))
+
+        await self._run(self._transaction, _finish)
+
+    async def list_guild_settings(self):
+        rows = await self._run(lambda: self.conn.execute(SELECT_SETTINGS).fetchall())
+        return [_settings_row(row) for row in rows]
+
+    async def get_guild_settings(self, guild_id):
+        row = await self._run(
+            lambda: self.conn.execute(
+                SELECT_SETTINGS + " WHERE guild_id=?", (guild_id,)
+            ).fetchone()
+        )
+        return _settings_row(row) if row else None
+
+    async def save_guild_settings(
+        self, guild_id, enabled, min_words, excluded_channels, level_rules
+    ):
+        await self._run(
+            self.conn.execute,
+            "INSERT OR REPLACE INTO guild_settings (guild_id, enabled, min_words, excluded_channels, level_rules) VALUES (?, ?, ?, ?, ?)",
+            (
+                guild_id,
+                enabled,
+                min_words,
+                json.dumps(sorted(excluded_channels)),
+                json.dumps(level_rules) if level_rules else None,
+            ),
+        )
+
+    async def save_profiles(self, profiles, renames):
+        def _save():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO user_profile (guild_id, user_id, name, is_member, refreshed_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (guild_id, user_id, name, is_member, int(refreshed_at.timestamp()))
+                    for guild_id, user_id, name, is_member, refreshed_at in profiles
+                ],
+            )
+            self.conn.executemany(
+                "UPDATE user_profile SET name=?, refreshed_at=? WHERE user_id=?",
+                [
+                    (name, int(refreshed_at.timestamp()), user_id)
+                    for user_id, name, refreshed_at in renames
+                ],
+            )
+
+        await self._run(self._transaction, _save)
+
+    async def get_profiles(self, guild_id, user_ids):
+        def _get():
+            rows = []
+            # Stays below SQLite's default limit of 999 variables
+            for i in range(0, len(user_ids), 900):
+                chunk = user_ids[i : i + 900]
+                rows += self.conn.execute(
+                    f"SELECT user_id, name, is_member, refreshed_at FROM user_profile WHERE guild_id=? AND user_id IN ({','.join('?' * len(chunk))})",
+                    (guild_id, *chunk),
+                ).fetchall()
+            return rows
+
+        return [
+            (
+                user_id,
+                name,
+                bool(is_member),
+                datetime.fromtimestamp(refreshed_at, timezone.utc),
+            )
+            for user_id, name, is_member, refreshed_at in await self._run(_get)
+        ]
+
+    async def stale_profiles(self, before, limit, guild_ids):
+        rows = await self._run(
+            lambda: self.conn.execute(
+                # The ids go in as one JSON array, there may be more than variables allowed
+                "SELECT DISTINCT user_id FROM (SELECT user_id FROM user_profile WHERE refreshed_at < ? AND guild_id IN (SELECT value FROM json_each(?)) ORDER BY refreshed_at LIMIT ?)",
+                (int(before.timestamp()), json.dumps(guild_ids), limit),
+            ).fetchall()
+        )
+        return [user_id for (user_id,) in rows]
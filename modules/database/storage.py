@@ -0,0 +1,520 @@
+import json
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime, time, timedelta, timezone
+from time import perf_counter
+
+UPSERT_COUNTS = """
+INSERT INTO message_count (guild_id, user_id, message_count)
+SELECT * FROM UNNEST($1::bigint[], $2::bigint[], $3::bigint[])
+ON CONFLICT (guild_id, user_id) DO UPDATE
+SET message_count = message_count.message_count + EXCLUDED.message_count
+RETURNING guild_id, user_id, message_count
+"""
+ADD_ACTIVITY = """
+INSERT INTO activity_hourly (guild_id, user_id, hour, messages)
+SELECT guild_id, user_id, $4, messages
+FROM UNNEST($1::bigint[], $2::bigint[], $3::integer[]) AS rows (guild_id, user_id, messages)
+ON CONFLICT (guild_id, user_id, hour) DO UPDATE
+SET messages = activity_hourly.messages + EXCLUDED.messages
+"""
+ROLLUP_HOURLY = """
+INSERT INTO activity_daily (guild_id, day, user_id, messages)
+SELECT guild_id, (hour AT TIME ZONE 'UTC')::date, user_id, sum(messages)
+FROM activity_hourly WHERE hour < $1
+GROUP BY 1, 2, 3
+ON CONFLICT (guild_id, day, user_id) DO UPDATE
+SET messages = activity_daily.messages + EXCLUDED.messages
+"""
+RECENT_ACTIVITY = """
+SELECT user_id, sum(messages) FROM (
+    SELECT user_id, messages FROM activity_daily WHERE guild_id=$1 AND day >= $2::date
+    UNION ALL
+    SELECT user_id, messages FROM activity_hourly WHERE guild_id=$1 AND hour >= $2
+) activity GROUP BY user_id
+"""
+USER_ACTIVITY = """
+SELECT coalesce(sum(messages), 0) FROM (
+    SELECT messages FROM activity_daily WHERE guild_id=$1 AND user_id=$2 AND day >= $3::date
+    UNION ALL
+    SELECT messages FROM activity_hourly WHERE guild_id=$1 AND user_id=$2 AND hour >= $3
+) activity
+"""
+# Arbitrary key, only one process of a cluster compacts at a time
+ROLLUP_LOCK = 0x506F73746E526F6D
+PARTITION_NAME = re.compile(r"activity_hourly_(\d{8})")
+SAVE_CHECKPOINT = """
+INSERT INTO init_checkpoint (guild_id, channel_id, last_message_id, done)
+VALUES ($1, $2, $3, $4)
+ON CONFLICT (guild_id, channel_id) DO UPDATE
+SET last_message_id = EXCLUDED.last_message_id, done = EXCLUDED.done
+"""
+SAVE_SETTINGS = """
+INSERT INTO guild_settings (guild_id, enabled, min_words, excluded_channels, level_rules)
+VALUES ($1, $2, $3, $4, $5::jsonb)
+ON CONFLICT (guild_id) DO UPDATE
+SET enabled = EXCLUDED.enabled, min_words = EXCLUDED.min_words,
+excluded_channels = EXCLUDED.excluded_channels, level_rules = EXCLUDED.level_rules
+"""
+SAVE_PROFILES = """
+INSERT INTO user_profile (guild_id, user_id, name, is_member, refreshed_at)
+SELECT * FROM UNNEST($1::bigint[], $2::bigint[], $3::text[], $4::boolean[], $5::timestamptz[])
+ON CONFLICT (guild_id, user_id) DO UPDATE
+SET name = EXCLUDED.name, is_member = EXCLUDED.is_member, refreshed_at = EXCLUDED.refreshed_at
+"""
+RENAME_PROFILES = """
+UPDATE user_profile SET name = renamed.name, refreshed_at = renamed.refreshed_at
+FROM UNNEST($1::bigint[], $2::text[], $3::timestamptz[]) AS renamed (user_id, name, refreshed_at)
+WHERE user_profile.user_id = renamed.user_id
+"""
+SELECT_SETTINGS = "SELECT guild_id, enabled, min_words, excluded_channels, level_rules FROM guild_settings"
+
+# Every query of PostgresStorage, run by name through PostgresStorage.run
+STATEMENTS = {
+    "ping": "SELECT 1",
+    "upsert_counts": UPSERT_COUNTS,
+    "add_activity": ADD_ACTIVITY,
+    "rollup_hourly": ROLLUP_HOURLY,
+    "recent_activity": RECENT_ACTIVITY,
+    "user_activity": USER_ACTIVITY,
+    "try_rollup_lock": "SELECT pg_try_advisory_xact_lock($1)",
+    "activity_partitions": "SELECT relname FROM pg_inherits JOIN pg_class ON pg_class.oid = inhrelid "
+    "WHERE inhparent = 'activity_hourly'::regclass",
+    "delete_default_hourly": "DELETE FROM activity_hourly_default WHERE hour < $1",
+    "delete_daily": "DELETE FROM activity_daily WHERE day < $1",
+    "get_count": "SELECT message_count FROM message_count WHERE guild_id=$1 AND user_id=$2",
+    "iter_guild": "SELECT user_id, message_count FROM message_count WHERE guild_id=$1",
+    "top_counts": "SELECT user_id, message_count FROM message_count WHERE guild_id=$1 "
+    "ORDER BY message_count DESC, user_id LIMIT $2 OFFSET $3",
+    "delete_guild_counts": "DELETE FROM message_count WHERE guild_id=$1",
+    "delete_checkpoints": "DELETE FROM init_checkpoint WHERE guild_id=$1",
+    "start_backfill": "INSERT INTO init_state (guild_id, boundary_id, channel_id, message_id) VALUES ($1, $2, $3, $4) "
+    "ON CONFLICT (guild_id) DO UPDATE SET boundary_id = EXCLUDED.boundary_id, "
+    "channel_id = EXCLUDED.channel_id, message_id = EXCLUDED.message_id, started_at = now()",
+    "save_checkpoint": SAVE_CHECKPOINT,
+    "get_backfill": "SELECT boundary_id FROM init_state WHERE guild_id=$1",
+    "list_backfills": "SELECT guild_id, boundary_id, channel_id, message_id FROM init_state",
+    "backfill_checkpoints": "SELECT channel_id, last_message_id, done FROM init_checkpoint WHERE guild_id=$1",
+    "delete_backfill": "DELETE FROM init_state WHERE guild_id=$1",
+    "list_settings": SELECT_SETTINGS,
+    "get_settings": SELECT_SETTINGS + " WHERE guild_id=$1",
+    "save_settings": SAVE_SETTINGS,
+    "save_profiles": SAVE_PROFILES,
+    "rename_profiles": RENAME_PROFILES,
+    "get_profiles": "SELECT user_id, name, is_member, refreshed_at FROM user_profile "
+    "WHERE guild_id=$1 AND user_id = ANY($2::bigint[])",
+    "stale_profiles": "SELECT DISTINCT user_id FROM (SELECT user_id FROM user_profile "
+    "WHERE refreshed_at < $1 AND guild_id = ANY($3::bigint[]) ORDER BY refreshed_at LIMIT $2) stale",
+}
+
+
+def _settings_row(row):
+    guild_id, enabled, min_words, excluded_channels, level_rules = row
+    return (
+        guild_id,
+        enabled,
+        min_words,
+        excluded_channels,
+        json.loads(level_rules) if level_rules else None,
+    )
+
+
+def day_start(day):
+    return datetime.combine(day, time(), timezone.utc)
+
+
+class Storage:
+    """What the counter needs from a database.
+
+    Counts are (guild_id, user_id, message_count) rows. Activity is kept
+    in hourly buckets that are compacted into daily ones after a few days,
+    so windows read a few rows per user. Backfill state records a guild's
+    boundary snowflake, where its progress message lives and a checkpoint
+    per channel.
+    """
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def ping(self):
+        """Runs a trivial query, how long it takes is the database's round trip."""
+        raise NotImplementedError
+
+    async def upsert_counts(self, rows, hour=None):
+        """Adds the rows' counts in one transaction, returns the new totals.
+
+        With an hour (an aware UTC datetime) the counts are added to that
+        hour's activity in the same transaction.
+        """
+        raise NotImplementedError
+
+    async def recent_activity(self, guild_id, since):
+        """Returns {user_id: messages} of the guild's activity since the UTC datetime."""
+        raise NotImplementedError
+
+    async def user_activity(self, guild_id, user_id, since):
+        raise NotImplementedError
+
+    async def rollup_activity(self, now, hourly_days, retention_days):
+        """Compacts hours older than hourly_days into days, drops days past the retention."""
+        raise NotImplementedError
+
+    async def get_count(self, guild_id, user_id):
+        raise NotImplementedError
+
+    def iter_guild(self, guild_id, replica=False):
+        """Asynchronously yields a guild's (user_id, message_count) rows.
+
+        With replica the rows may come from a read replica that lags a
+        little behind, callers that just wrote rows leave it off.
+        """
+        raise NotImplementedError
+
+    async def top_counts(self, guild_id, limit, offset=0):
+        """Returns a guild's (user_id, message_count) rows, highest first."""
+        raise NotImplementedError
+
+    async def start_backfill(
+        self, guild_id, boundary_id, channel_id, message_id, channel_ids
+    ):
+        """Resets the guild's counts and records a new backfill."""
+        raise NotImplementedError
+
+    async def get_backfill(self, guild_id):
+        """Returns the boundary of the guild's unfinished backfill, if any."""
+        raise NotImplementedError
+
+    async def list_backfills(self):
+        """Returns (guild_id, boundary_id, channel_id, message_id) of unfinished backfills."""
+        raise NotImplementedError
+
+    async def backfill_checkpoints(self, guild_id):
+        """Returns the channel total and (channel_id, last_message_id) of unfinished channels."""
+        raise NotImplementedError
+
+    async def save_checkpoint(self, guild_id, channel_id, last_message_id, done, rows):
+        """Adds partial counts and moves the channel's checkpoint in one transaction."""
+        raise NotImplementedError
+
+    async def finish_backfill(self, guild_id):
+        raise NotImplementedError
+
+    async def list_guild_settings(self):
+        """Returns (guild_id, enabled, min_words, excluded_channels, level_rules) rows."""
+        raise NotImplementedError
+
+    async def get_guild_settings(self, guild_id):
+        raise NotImplementedError
+
+    async def save_guild_settings(
+        self, guild_id, enabled, min_words, excluded_channels, level_rules
+    ):
+        """Inserts or replaces a guild's settings, level_rules are (role, messages, days)."""
+        raise NotImplementedError
+
+    async def save_profiles(self, profiles, renames):
+        """Writes user profiles in one transaction.
+
+        profiles are (guild_id, user_id, name, is_member, refreshed_at) rows
+        and are inserted or replaced. renames are (user_id, name, refreshed_at)
+        and apply to every guild's profile of the user, after the profiles.
+        """
+        raise NotImplementedError
+
+    async def get_profiles(self, guild_id, user_ids):
+        """Returns (user_id, name, is_member, refreshed_at) of the users with a profile."""
+        raise NotImplementedError
+
+    async def stale_profiles(self, before, limit, guild_ids):
+        """Returns the ids of users with a profile not refreshed since the UTC datetime.
+
+        Only profiles of the guilds are looked at, every process of a
+        cluster refreshes the users of its own guilds.
+        """
+        raise NotImplementedError
+
+
+class PostgresStorage(Storage):
+    """Storage on PostgreSQL, optionally reading from a replica.
+
+    Queries run by name from STATEMENTS. asyncpg prepares a statement the
+    first time a connection runs it and reuses it from the connection's
+    statement cache afterwards, the cache is sized to hold all of them.
+    Reads that can lag behind a little go to the replica pool when one is
+    configured, so they don't compete with flushes for primary connections.
+    """
+
+    def __init__(
+        self,
+        creds,
+        batch_size,
+        acquire_wait,
+        statement_latency,
+        logger,
+        replica_creds=None,
+        pool_size=(10, 20),
+        replica_pool_size=(2, 10),
+    ):
+        self.creds = creds
+        self.replica_creds = replica_creds
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.replica_pool_size = replica_pool_size
+        self.acquire_wait = acquire_wait
+        self.statement_latency = statement_latency
+        self.logger = logger
+        self.pool = None
+        self.replica = None
+
+    async def _create_pool(self, creds, pool_size):
+        from asyncpg import create_pool
+
+        return await create_pool(
+            **creds,
+            min_size=pool_size[0],
+            max_size=pool_size[1],
+            timeout=10.0,
+            command_timeout=60.0,
+            statement_cache_size=max(100, 2 * len(STATEMENTS)),
+        )
+
+    async def connect(self):
+        from .migrations import migrate
+
+        self.pool = await self._create_pool(self.creds, self.pool_size)
+        await migrate(self.pool, self.logger)
+        if self.replica_creds:
+            self.replica = await self._create_pool(
+                self.replica_creds, self.replica_pool_size
+            )
+
+    async def close(self):
+        for pool in (self.replica, self.pool):
+            if pool and pool._initialized and not pool._closed:
+                await pool.close()
+
+    @asynccontextmanager
+    async def acquire(self, replica=False):
+        """Acquires a connection, of the replica if asked for and configured.
+
+        Records how long the wait for the pool took.
+        """
+        if replica and self.replica:
+            pool, name = self.replica, "replica"
+        else:
+            pool, name = self.pool, "primary"
+        started = perf_counter()
+        async with pool.acquire() as conn:
+            self.acquire_wait.labels(name).observe(perf_counter() - started)
+            yield conn
+
+    async def run(self, conn, method, name, *args):
+        """Runs a named statement with the connection's fetch, fetchval, execute, ..."""
+        started = perf_counter()
+        try:
+            return await getattr(conn, method)(STATEMENTS[name], *args)
+        finally:
+            self.statement_latency.labels(name).observe(perf_counter() - started)
+
+    async def ping(self):
+        async with self.acquire() as conn:
+            await self.run(conn, "fetchval", "ping")
+
+    async def _upsert(self, conn, rows, hour=None):
+        results = []
+        for i in range(0, len(rows), self.batch_size):
+            guild_ids, user_ids, counts = zip(*rows[i : i + self.batch_size])
+            results += await self.run(
+                conn, "fetch", "upsert_counts", guild_ids, user_ids, counts
+            )
+            if hour:
+                await self.run(
+                    conn, "execute", "add_activity", guild_ids, user_ids, counts, hour
+                )
+        return results
+
+    async def upsert_counts(self, rows, hour=None):
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                return await self._upsert(conn, rows, hour)
+
+    async def recent_activity(self, guild_id, since):
+        async with self.acquire(replica=True) as conn:
+            return dict(
+                await self.run(conn, "fetch", "recent_activity", guild_id, since)
+            )
+
+    async def user_activity(self, guild_id, user_id, since):
+        async with self.acquire(replica=True) as conn:
+            return await self.run(
+                conn, "fetchval", "user_activity", guild_id, user_id, since
+            )
+
+    async def _create_partition(self, conn, day):
+        # DDL takes no parameters, the bounds are formatted from dates
+        try:
+            async with conn.transaction():
+                await conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS activity_hourly_{day:%Y%m%d} PARTITION OF activity_hourly "
+                    f"FOR VALUES FROM ('{day_start(day).isoformat()}') TO ('{day_start(day + timedelta(days=1)).isoformat()}')"
+                )
+        except Exception as e:
+            # The default partition already holds rows of that day
+            self.logger.warning(f"Couldn't create the activity partition of {day}: {e}")
+
+    async def rollup_activity(self, now, hourly_days, retention_days):
+        today = now.date()
+        cutoff = day_start(today - timedelta(days=hourly_days))
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                if not await self.run(conn, "fetchval", "try_rollup_lock", ROLLUP_LOCK):
+                    return
+                for day in (today, today + timedelta(days=1)):
+                    await self._create_partition(conn, day)
+                await self.run(conn, "execute", "rollup_hourly", cutoff)
+                # Whole days are dropped, only stray rows are deleted
+                for (name,) in await self.run(conn, "fetch", "activity_partitions"):
+                    match = PARTITION_NAME.fullmatch(name)
+                    if (
+                        match
+                        and datetime.strptime(match[1], "%Y%m%d").date() < cutoff.date()
+                    ):
+                        await conn.execute(f"DROP TABLE {name}")
+                await self.run(conn, "execute", "delete_default_hourly", cutoff)
+                await self.run(
+                    conn,
+                    "execute",
+                    "delete_daily",
+                    today - timedelta(days=retention_days),
+                )
+
+    async def get_count(self, guild_id, user_id):
+        # Not the replica, what's read is cached and has to include every flush
+        async with self.acquire() as conn:
+            return await self.run(conn, "fetchval", "get_count", guild_id, user_id)
+
+    async def iter_guild(self, guild_id, replica=False):
+        async with self.acquire(replica) as conn:
+            async with conn.transaction():
+                async for user_id, message_count in conn.cursor(
+                    STATEMENTS["iter_guild"], guild_id, prefetch=1000
+                ):
+                    yield user_id, message_count
+
+    async def top_counts(self, guild_id, limit, offset=0):
+        async with self.acquire(replica=True) as conn:
+            return await self.run(conn, "fetch", "top_counts", guild_id, limit, offset)
+
+    async def start_backfill(
+        self, guild_id, boundary_id, channel_id, message_id, channel_ids
+    ):
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await self.run(conn, "execute", "delete_guild_counts", guild_id)
+                await self.run(conn, "execute", "delete_checkpoints", guild_id)
+                await self.run(
+                    conn,
+                    "execute",
+                    "start_backfill",
+                    guild_id,
+                    boundary_id,
+                    channel_id,
+                    message_id,
+                )
+                await self.run(
+                    conn,
+                    "executemany",
+                    "save_checkpoint",
+                    [(guild_id, channel_id, None, False) for channel_id in channel_ids],
+                )
+
+    async def get_backfill(self, guild_id):
+        async with self.acquire() as conn:
+            return await self.run(conn, "fetchval", "get_backfill", guild_id)
+
+    async def list_backfills(self):
+        async with self.acquire() as conn:
+            return await self.run(conn, "fetch", "list_backfills")
+
+    async def backfill_checkpoints(self, guild_id):
+        async with self.acquire() as conn:
+            checkpoints = await self.run(
+                conn, "fetch", "backfill_checkpoints", guild_id
+            )
+        return len(checkpoints), [
+            (channel_id, last_message_id)
+            for channel_id, last_message_id, done in checkpoints
+            if not done
+        ]
+
+    async def save_checkpoint(self, guild_id, channel_id, last_message_id, done, rows):
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                if rows:
+                    await self._upsert(conn, rows)
+                await self.run(
+                    conn,
+                    "execute",
+                    "save_checkpoint",
+                    guild_id,
+                    channel_id,
+                    last_message_id,
+                    done,
+                )
+
+    async def finish_backfill(self, guild_id):
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await self.run(conn, "execute", "delete_checkpoints", guild_id)
+                await self.run(conn, "execute", "delete_backfill", guild_id)
+
+    async def list_guild_settings(self):
+        async with self.acquire() as conn:
+            return [
+                _settings_row(row)
+                for row in await self.run(conn, "fetch", "list_settings")
+            ]
+
+    async def get_guild_settings(self, guild_id):
+        async with self.acquire() as conn:
+            row = await self.run(conn, "fetchrow", "get_settings", guild_id)
+        return _settings_row(row) if row else None
+
+    async def save_guild_settings(
+        self, guild_id, enabled, min_words, excluded_channels, level_rules
+    ):
+        async with self.acquire() as conn:
+            await self.run(
+                conn,
+                "execute",
+                "save_settings",
+                guild_id,
+                enabled,
+                min_words,
+                sorted(excluded_channels),
+                json.dumps(level_rules) if level_rules else None,
+            )
+
+    async def save_profiles(self, profiles, renames):
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                if profiles:
+                    await self.run(conn, "execute", "save_profiles", *zip(*profiles))
+                if renames:
+                    await self.run(conn, "execute", "rename_profiles", *zip(*renames))
+
+    async def get_profiles(self, guild_id, user_ids):
+        async with self.acquire(replica=True) as conn:
+            return await self.run(conn, "fetch", "get_profiles", guild_id, user_ids)
+
+    async def stale_profiles(self, before, limit, guild_ids):
+        async with self.acquire() as conn:
+            return [
+                user_id
+                for (user_id,) in await self.run(
+                    conn, "fetch", "stale_profiles", before, limit, guild_ids
+                )
+            ]
@@ -1,7 +1,5 @@
 from asyncio import TimeoutError
 from datetime import timedelta
-from sys import stderr
-from traceback import print_tb
 
 from aiohttp import ClientOSError, ContentTypeError, ServerDisconnectedError
 from discord import HTTPException
@@ -64,12 +62,7 @@ class ErrorHandler(commands.Cog):
                 # Called on 500 HTTP responses
                 # TimeoutError: A Discord operation timed out. All others should be handled by us
                 return
-            print("In {}:".format(ctx.command.qualified_name), file=stderr)
-            print_tb(error.original.__traceback__)
-            print(
-                "{0}: {1}".format(error.original.__class__.__name__, error.original),
-                file=stderr,
-            )
+            self.bot.errors.report(ctx.command.qualified_name, error.original)
 
 
 def setup(bot):
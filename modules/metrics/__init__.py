@@ -0,0 +1,245 @@
+import resource
+from bisect import bisect_left
+from time import perf_counter
+
+from discord.ext import commands
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def resident_memory():
+    """Returns the process' resident set size in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Not on Linux, the peak is the best there is (in KiB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """A named metric with optional labels.
+
+    Children for a set of label values are created once and can be kept
+    around, so updating them on a hot path is a plain attribute increment.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _label_string(self, values, extra=()):
+        pairs = [*zip(self.labelnames, values), *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def render(self):
+        yield from super().render()
+        for values, child in self.children.items():
+            yield f"{self.name}{self._label_string(values)} {child.value}"
+
+
+class Gauge(Metric):
+    """A value read from a callback whenever the metrics are collected."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        if not self.function:
+            return
+        try:
+            value = self.function()
+        except Exception:
+            # The owner of the callback went away, e.g. an unloaded cog
+            return
+        yield from super().render()
+        yield f"{self.name} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        yield from super().render()
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), child.counts):
+                cumulative += count
+                labels = self._label_string(values, (("le", bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{self._label_string(values)} {child.sum}"
+            yield f"{self.name}_count{self._label_string(values)} {child.count}"
+
+
+class Registry:
+    """Holds the bot's metrics, created by bot.py and shared by all cogs.
+
+    Metrics are looked up by name, so a reloaded cog gets its previous
+    metric back instead of starting from zero.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, function=None):
+        gauge = self._get(Gauge, name, documentation)
+        if function:
+            gauge.set_function(function)
+        return gauge
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Metrics(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.runner = None
+        self.command_latency = bot.metrics.histogram(
+            "postnrole_command_duration_seconds",
+            "Time taken by command invocations",
+            ["command"],
+        )
+        bot.metrics.gauge(
+            "postnrole_resident_memory_bytes",
+            "Resident set size of the process",
+            resident_memory,
+        )
+        bot.metrics.gauge(
+            "postnrole_cached_members",
+            "Members held by the gateway cache",
+            lambda: sum(len(guild._members) for guild in self.bot.guilds),
+        )
+        port = getattr(bot.config, "metrics_port", None)
+        if port:
+            bot.tasks.spawn("startup", self.start_server(port), owner=self)
+
+    async def start_server(self, port):
+        from aiohttp import web
+
+        async def _metrics(request):
+            return web.Response(
+                text=self.bot.metrics.render(), content_type="text/plain"
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", _metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(
+            self.runner, getattr(self.bot.config, "metrics_host", "127.0.0.1"), port
+        ).start()
+        self.bot.logger.info(f"Serving metrics on port {port}.")
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        ctx.started_at = perf_counter()
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        self.observe(ctx)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        self.observe(ctx)
+
+    def observe(self, ctx):
+        started_at = getattr(ctx, "started_at", None)
+        if started_at is not None and ctx.command:
+            self.command_latency.labels(ctx.command.qualified_name).observe(
+                perf_counter() - started_at
+            )
+
+    def cog_unload(self):
+        self.bot.tasks.cancel_owner(self)
+        if self.runner:
+            self.bot.tasks.spawn("shutdown", self.runner.cleanup())
+
+
+def setup(bot):
+    bot.add_cog(Metrics(bot))
@@ -1,18 +1,74 @@
+from datetime import datetime, timezone
+from io import BytesIO
+from time import perf_counter
+
+from discord import File
 from discord.ext import commands
 
+from .watchdog import LoopWatchdog
+
 
 class Misc(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.watchdog = LoopWatchdog(
+            bot,
+            getattr(bot.config, "loop_lag_interval", 0.1),
+            getattr(bot.config, "loop_lag_threshold", 0.25),
+            getattr(bot.config, "loop_lag_window", 300.0),
+        )
+        bot.tasks.spawn("watchdog", self.watchdog.run(), owner=self)
+
+    def cog_unload(self):
+        self.bot.tasks.cancel_owner(self)
+
+    async def database_round_trip(self):
+        db = getattr(self.bot, "db", None)
+        if not db or not db.is_ready:
+            return "unavailable"
+        started = perf_counter()
+        try:
+            await db.storage.ping()
+        except Exception as e:
+            return f"failed ({type(e).__name__})"
+        return f"{(perf_counter() - started) * 1000:.2f} ms"
 
     @commands.command()
     async def ping(self, ctx):
-        """Returns the average of the discord websocket latency from the past one minute"""
-        await ctx.send(
-            f"The average discord websocket latency is: `{round(self.bot.latency * 1000, 2)}` ms.",
-            reference=ctx.message,
-            mention_author=False,
+        """Returns the websocket, REST and database latencies and the event loop lag"""
+        started = perf_counter()
+        message = await ctx.send(
+            "Pinging...", reference=ctx.message, mention_author=False
+        )
+        rest = perf_counter() - started
+        database = await self.database_round_trip()
+        p50, p95, p99 = self.watchdog.percentiles(0.5, 0.95, 0.99)
+        await message.edit(
+            content=(
+                f"**Websocket:** `{round(self.bot.latency * 1000, 2)}` ms (average of the past minute)\n"
+                f"**REST:** `{round(rest * 1000, 2)}` ms\n"
+                f"**Database:** `{database}`\n"
+                f"**Event loop lag:** p50 `{p50 * 1000:.2f}` ms, p95 `{p95 * 1000:.2f}` ms, "
+                f"p99 `{p99 * 1000:.2f}` ms, max `{max(self.watchdog.lags, default=0) * 1000:.2f}` ms\n"
+                f"**Loop stalls:** `{len(self.watchdog.stalls)}` recently over "
+                f"`{self.watchdog.threshold}`s"
+            )
+        )
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def stalls(self, ctx):
+        """Attaches the stacks the event loop was recently blocked in"""
+        if not self.watchdog.stalls:
+            return await ctx.send("The event loop wasn't blocked recently.")
+        report = "\n\n".join(
+            f"{stall.task}, blocked "
+            + (f"for {stall.duration:.3f}s" if stall.duration else "(ongoing)")
+            + f" at {datetime.fromtimestamp(stall.at, timezone.utc):%Y-%m-%d %H:%M:%S} UTC:\n"
+            + stall.stack
+            for stall in self.watchdog.stalls
         )
+        await ctx.send(file=File(BytesIO(report.encode()), "stalls.txt"))
 
     @commands.command()
     async def source(self, ctx):
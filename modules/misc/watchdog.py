@@ -0,0 +1,100 @@
+import sys
+from asyncio import current_task, sleep
+from collections import deque
+from threading import Event, Thread, get_ident
+from time import monotonic, time
+from traceback import format_stack
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Stall:
+    __slots__ = ("at", "task", "stack", "duration")
+
+    def __init__(self, at, task, stack):
+        self.at = at
+        self.task = task
+        self.stack = stack
+        # Filled in once the loop runs again
+        self.duration = None
+
+
+class LoopWatchdog:
+    """Measures how late the event loop wakes up a sleeping coroutine.
+
+    The lag is how long callbacks ahead of it kept the loop busy. A second
+    thread notices when the loop didn't tick for threshold seconds and
+    captures the stack it's stuck in, while it's still stuck.
+    """
+
+    def __init__(self, bot, interval, threshold, window):
+        self.bot = bot
+        self.interval = interval
+        self.threshold = threshold
+        # Lags of the last window seconds
+        self.lags = deque(maxlen=max(int(window / interval), 1))
+        self.stalls = deque(maxlen=10)
+        self.lag_histogram = bot.metrics.histogram(
+            "postnrole_loop_lag_seconds",
+            "Delay of the event loop in waking up a sleeping coroutine",
+            buckets=LAG_BUCKETS,
+        )
+        self.stall_count = bot.metrics.counter(
+            "postnrole_loop_stalls_total",
+            "Times the event loop was blocked for longer than the threshold",
+        )
+        self.loop_thread_id = None
+        self.beat = None
+        self._stall = None
+        self._stop = Event()
+
+    async def run(self):
+        """Measures until cancelled, the thread only watches while this runs."""
+        loop = self.bot.loop
+        self.loop_thread_id = get_ident()
+        self.beat = monotonic()
+        self._stop.clear()
+        Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                await sleep(self.interval)
+                lag = max(loop.time() - expected, 0.0)
+                self.beat = monotonic()
+                self.lags.append(lag)
+                self.lag_histogram.observe(lag)
+                stall, self._stall = self._stall, None
+                if stall:
+                    stall.duration = lag
+                    self.bot.logger.warning(
+                        f"The event loop was blocked for {lag:.3f}s in {stall.task}."
+                    )
+        finally:
+            self._stop.set()
+
+    def watch(self):
+        while not self._stop.wait(self.threshold / 2):
+            if self._stall or monotonic() - self.beat < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            task = current_task(self.bot.loop)
+            self._stall = Stall(
+                time(),
+                task.get_name() if task else "a callback",
+                "".join(format_stack(frame)),
+            )
+            self.stalls.append(self._stall)
+            self.stall_count.inc()
+            self.bot.logger.warning(
+                f"The event loop is blocked for over {self.threshold}s, "
+                f"in {self._stall.task}:\n{self._stall.stack.rstrip()}"
+            )
+
+    def percentiles(self, *quantiles):
+        """Returns the lags at the quantiles, e.g. 0.5 and 0.99, of the window."""
+        lags = sorted(self.lags)
+        if not lags:
+            return [0.0 for _ in quantiles]
+        return [lags[min(int(q * len(lags)), len(lags) - 1)] for q in quantiles]
@@ -1,19 +1,37 @@
+from asyncio import sleep
 from contextlib import redirect_stdout
-from io import StringIO
+from copy import copy
+from datetime import timedelta
+from io import BytesIO, StringIO
 from textwrap import indent
+from time import time
 from traceback import format_exc
 
+from discord import File
 from discord.ext import commands
 
+from modules.metrics import resident_memory
+
+from .profiling import AllocationDiff, CallProfiler, StackSampler
+
+# Longest allocation diff the profile memory command takes, in seconds
+MAX_ALLOCATION_WINDOW = 600.0
+
 
 class Owner(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self._last_result = None
+        self.profiler = None
+        self.allocations = None
 
     async def cog_check(self, ctx):
         return await self.bot.is_owner(ctx.author)
 
+    def cog_unload(self):
+        if self.profiler:
+            self.profiler.stop()
+
     def cleanup_code(self, content):
         """Automatically removes code blocks from the code."""
         # remove ```py\n```
@@ -23,9 +41,16 @@ class Owner(commands.Cog):
         # remove `foo`
         return content.strip("` \n")
 
+    async def broadcast_extension(self, ctx, operation, module):
+        """Has every process of the cluster apply the operation, see launcher.py."""
+        self.bot.cluster.send("extension", operation, module)
+        await ctx.send("`SENT` to all clusters, check the logs for the results")
+
     @commands.command()
     async def reload(self, ctx, *, module: str):
         """Reloads a module"""
+        if self.bot.cluster:
+            return await self.broadcast_extension(ctx, "reload", module)
         try:
             self.bot.reload_extension(f"modules.{module}")
         except Exception as e:
@@ -36,6 +61,8 @@ class Owner(commands.Cog):
     @commands.command()
     async def load(self, ctx, *, module: str):
         """Loads a module"""
+        if self.bot.cluster:
+            return await self.broadcast_extension(ctx, "load", module)
         try:
             self.bot.load_extension(f"modules.{module}")
         except Exception as e:
@@ -46,6 +73,8 @@ class Owner(commands.Cog):
     @commands.command()
     async def unload(self, ctx, *, module: str):
         """Unloads a module"""
+        if self.bot.cluster:
+            return await self.broadcast_extension(ctx, "unload", module)
         try:
             self.bot.unload_extension(f"modules.{module}")
         except Exception as e:
@@ -53,6 +82,137 @@ class Owner(commands.Cog):
         else:
             await ctx.send("`SUCCESS`")
 
+    @commands.command()
+    async def modules(self, ctx):
+        """Shows how long each module took to load and to become ready"""
+        loader = self.bot.loader
+        lines = []
+        for name in self.bot.config.modules:
+            if name in loader.failed:
+                state = "failed"
+            elif name in loader.ready_times:
+                state = f"ready after {loader.ready_times[name]:.2f}s"
+            else:
+                state = "starting"
+            load_time = loader.load_times.get(name)
+            lines.append(
+                f"**{name}:** {state}"
+                + (f", setup took {load_time * 1000:.1f}ms" if load_time else "")
+            )
+        await ctx.send("\n".join(lines))
+
+    @commands.command()
+    async def tasks(self, ctx):
+        """Shows the background task groups"""
+        lines = []
+        for name, group in sorted(self.bot.tasks.groups.items()):
+            lines.append(
+                f"**{name}:** `{group.running}`/`{group.limit or '∞'}` running, "
+                f"`{group.queued}`/`{'∞' if group.max_queued is None else group.max_queued}` queued, "
+                f"`{group.failed}` failed, `{group.rejected}` rejected"
+            )
+        await ctx.send("\n".join(lines) or "No background tasks were started yet.")
+
+    @commands.command()
+    async def errors(self, ctx, limit: int = 10):
+        """Shows the errors that occurred most often"""
+        now = time()
+        lines = [
+            f"`{entry.count}x` **{entry.source}** `{entry.type}` at `{entry.frame}`\n"
+            f"  first `{timedelta(seconds=int(now - entry.first_seen))}` ago, "
+            f"last `{timedelta(seconds=int(now - entry.last_seen))}` ago: {entry.message[:200]}"
+            for entry in self.bot.errors.top(limit)
+        ]
+        await ctx.send("\n".join(lines)[:2000] or "No errors were reported.")
+
+    @commands.command()
+    async def memory(self, ctx):
+        """Shows the memory use and the size of the caches"""
+        counter = self.bot.get_cog("Counter")
+        await ctx.send(
+            f"**Resident memory:** `{round(resident_memory() / 1024 ** 2, 1)}` MiB\n"
+            f"**Cached members:** `{sum(len(guild._members) for guild in self.bot.guilds)}` "
+            f"in `{len(self.bot.guilds)}` guilds\n"
+            f"**Cached users:** `{len(self.bot.users)}`"
+            + (
+                f"\n**Recent authors:** `{len(counter.members)}`/`{counter.members.maxsize}`, "
+                f"`{counter.members.queried}` members requested"
+                if counter
+                else ""
+            )
+        )
+
+    @commands.group(invoke_without_command=True)
+    async def profile(self, ctx):
+        """Profiles the running bot, see the subcommands"""
+        await ctx.send_help(ctx.command)
+
+    @profile.command(name="start")
+    async def profile_start(self, ctx, mode: str = "sample", interval: float = 5.0):
+        """Starts a CPU profile, mode is sample (every interval ms) or calls (cProfile)"""
+        if self.profiler:
+            return await ctx.send("`ERROR:` A profile is already running")
+        if mode == "sample":
+            self.profiler = StackSampler(max(interval, 1.0) / 1000)
+        elif mode == "calls":
+            self.profiler = CallProfiler()
+        else:
+            return await ctx.send("`ERROR:` The mode has to be sample or calls")
+        self.profiler.start()
+        await ctx.send(f"`STARTED` stop it with `{ctx.prefix}profile stop`")
+
+    @profile.command(name="stop")
+    async def profile_stop(self, ctx):
+        """Stops the CPU profile and attaches its report"""
+        profiler, self.profiler = self.profiler, None
+        if not profiler:
+            return await ctx.send("`ERROR:` No profile is running")
+        profiler.stop()
+        await ctx.send(files=self.report_files(profiler))
+
+    @profile.command(name="memory")
+    async def profile_memory(self, ctx, seconds: float = 30.0, frames: int = 1):
+        """Compares the allocations before and after the given seconds"""
+        if self.allocations:
+            return await ctx.send("`ERROR:` An allocation diff is already running")
+        self.allocations = AllocationDiff(frames)
+        try:
+            self.allocations.start()
+            await ctx.send(f"`STARTED` reporting back in {seconds:g}s")
+            await sleep(min(seconds, MAX_ALLOCATION_WINDOW))
+            report = self.allocations.stop()
+        finally:
+            self.allocations = None
+        await ctx.send(file=File(BytesIO(report.encode()), "allocations.txt"))
+
+    @profile.command(name="command")
+    async def profile_command(self, ctx, *, command: str):
+        """Runs a command under cProfile and attaches the report"""
+        if isinstance(self.profiler, CallProfiler):
+            return await ctx.send("`ERROR:` A calls profile is already running")
+        message = copy(ctx.message)
+        message.content = ctx.prefix + command
+        new_ctx = await self.bot.get_context(message)
+        if not new_ctx.valid:
+            return await ctx.send(f"`ERROR:` No command named {command.split()[0]}")
+        # Whatever else the event loop runs meanwhile shows up as well
+        profiler = CallProfiler()
+        profiler.start()
+        try:
+            await new_ctx.command.invoke(new_ctx)
+        except Exception as e:
+            await ctx.send(f"`ERROR:` {type(e).__name__} - {e}")
+        finally:
+            profiler.stop()
+        await ctx.send(files=self.report_files(profiler))
+
+    def report_files(self, profiler):
+        files = [File(BytesIO(profiler.report().encode()), "profile.txt")]
+        if isinstance(profiler, StackSampler):
+            # For flamegraph.pl or speedscope
+            files.append(File(BytesIO(profiler.collapsed().encode()), "stacks.txt"))
+        return files
+
     @commands.command(name="eval")
     async def _eval(self, ctx, *, body: str):
         """Evaluates a code"""
@@ -0,0 +1,151 @@
+import cProfile
+import pstats
+import sys
+import tracemalloc
+from collections import Counter
+from io import StringIO
+from os import path
+from threading import Event, Thread, get_ident
+from time import perf_counter
+
+# Rows of the text reports
+REPORT_LIMIT = 40
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples the event loop thread's stack from a second thread.
+
+    Unlike cProfile it doesn't slow down every call, so it can stay on
+    while the bot is under load. Stacks are kept collapsed, the format
+    flamegraph.pl and speedscope read. The sampler needs the GIL to take
+    a sample, so intervals below sys.getswitchinterval() (5ms by default)
+    take fewer samples than asked for while the loop is busy.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.thread_id = get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self.started = perf_counter()
+        self._thread = Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.items())
+
+    def report(self):
+        if not self.samples:
+            return f"No samples were taken in {self.elapsed:.1f}s"
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            # A recursive function counts once per sample
+            for label in set(frames):
+                total[label] += count
+        lines = [
+            f"{self.samples} samples every {self.interval * 1000:g}ms over {self.elapsed:.1f}s",
+            "",
+            f"{'own':>7} {'total':>7}  function",
+        ]
+        for label, count in own.most_common(REPORT_LIMIT):
+            lines.append(
+                f"{count / self.samples:7.1%} {total[label] / self.samples:7.1%}  {label}"
+            )
+        lines += ["", f"{'total':>7}  function"]
+        for label, count in total.most_common(REPORT_LIMIT):
+            lines.append(f"{count / self.samples:7.1%}  {label}")
+        return "\n".join(lines)
+
+
+class CallProfiler:
+    """cProfile over everything the event loop runs while it's enabled."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.started = None
+        self.elapsed = 0.0
+
+    def start(self):
+        self.started = perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.elapsed = perf_counter() - self.started
+
+    def report(self):
+        stream = StringIO()
+        stream.write(f"Profiled for {self.elapsed:.1f}s\n")
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats("tottime").print_stats(REPORT_LIMIT)
+        stats.sort_stats("cumulative").print_stats(REPORT_LIMIT)
+        return stream.getvalue()
+
+
+class AllocationDiff:
+    """Allocations between two tracemalloc snapshots, grouped by line."""
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.started_tracing = False
+        self.before = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracing = True
+        self.before = tracemalloc.take_snapshot()
+
+    def stop(self):
+        after = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+        if self.started_tracing:
+            # Tracing slows down every allocation, don't leave it on
+            tracemalloc.stop()
+        ignored = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        differences = after.filter_traces(ignored).compare_to(
+            self.before.filter_traces(ignored), "lineno"
+        )
+        lines = [
+            f"Traced memory {traced / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB",
+            "",
+            "Largest growth:",
+        ]
+        lines += [str(difference) for difference in differences[:REPORT_LIMIT]]
+        lines += ["", "Largest allocation sites:"]
+        lines += [
+            str(statistic)
+            for statistic in after.filter_traces(ignored).statistics("lineno")[
+                :REPORT_LIMIT
+            ]
+        ]
+        return "\n".join(lines)
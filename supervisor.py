@@ -0,0 +1,171 @@
+"""Runs the bot's background work as named, bounded task groups.
+
+    bot.tasks.spawn("flush", self.flush(), owner=self)
+
+A group can limit how many of its tasks run at once, the others wait in
+the group's queue. spawn() turns work away once the queue is full, while
+`await bot.tasks.submit(...)` waits for room instead. Exceptions are
+logged with the group's name, and a cog calls
+`bot.tasks.cancel_owner(self)` in cog_unload to cancel what it started,
+running or still queued.
+"""
+
+from asyncio import Event, Semaphore
+
+# group -> (tasks running at once, tasks waiting for a slot), None is unbounded.
+# The "roles" group only holds the reconciler's fixed workers, its queue is
+# the reconciler's own, which keeps one entry per member.
+DEFAULT_LIMITS = {
+    "flush": (1, 0),
+    "backfill": (2, 8),
+    "member-requests": (4, 64),
+}
+
+
+class TaskGroup:
+    __slots__ = (
+        "name",
+        "limit",
+        "max_queued",
+        "running",
+        "unfinished",
+        "failed",
+        "rejected",
+        "_slots",
+        "_room",
+    )
+
+    def __init__(self, name, limit=None, max_queued=None):
+        self.name = name
+        self.limit = limit
+        self.max_queued = max_queued
+        self.running = 0
+        # Running plus queued, counted from spawn() on so a burst fills the queue
+        self.unfinished = 0
+        self.failed = 0
+        self.rejected = 0
+        self._slots = Semaphore(limit) if limit else None
+        self._room = Event()
+        self._room.set()
+
+    @property
+    def queued(self):
+        return self.unfinished - self.running
+
+    @property
+    def full(self):
+        """Whether a new task would have to wait and the queue has no room."""
+        if self.max_queued is None or self.limit is None:
+            return False
+        return self.unfinished >= self.limit + self.max_queued
+
+
+class TaskSupervisor:
+    def __init__(self, bot, limits=None):
+        self.bot = bot
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.groups = {}
+        # owner -> its unfinished tasks
+        self._owned = {}
+        self._failures = bot.metrics.counter(
+            "postnrole_task_failures_total",
+            "Background tasks that raised an exception",
+            ["group"],
+        )
+        self._rejections = bot.metrics.counter(
+            "postnrole_task_rejections_total",
+            "Background tasks turned away by a full queue",
+            ["group"],
+        )
+        bot.metrics.gauge(
+            "postnrole_tasks_running",
+            "Background tasks running",
+            lambda: sum(group.running for group in self.groups.values()),
+        )
+        bot.metrics.gauge(
+            "postnrole_tasks_queued",
+            "Background tasks waiting for a slot in their group",
+            lambda: sum(group.queued for group in self.groups.values()),
+        )
+
+    def group(self, name):
+        group = self.groups.get(name)
+        if group is None:
+            group = self.groups[name] = TaskGroup(name, *self.limits.get(name, ()))
+        return group
+
+    def spawn(self, name, coro, owner=None):
+        """Schedules the coroutine in the group, returns None if it was turned away."""
+        group = self.group(name)
+        if group.full:
+            coro.close()
+            group.rejected += 1
+            self._rejections.labels(name).inc()
+            return None
+        group.unfinished += 1
+        task = self.bot.loop.create_task(self._run(group, coro))
+        task.add_done_callback(lambda task: self._done(group, task, coro, owner))
+        if owner is not None:
+            self._owned.setdefault(owner, set()).add(task)
+        return task
+
+    async def submit(self, name, coro, owner=None):
+        """Like spawn, but waits for room in the group's queue."""
+        group = self.group(name)
+        try:
+            while group.full:
+                group._room.clear()
+                await group._room.wait()
+        except BaseException:
+            coro.close()
+            raise
+        return self.spawn(name, coro, owner)
+
+    async def join(self, name):
+        """Waits until the group has no running or queued tasks."""
+        group = self.group(name)
+        while group.unfinished:
+            group._room.clear()
+            await group._room.wait()
+
+    async def _run(self, group, coro):
+        if group._slots:
+            await group._slots.acquire()
+        group.running += 1
+        try:
+            return await coro
+        finally:
+            group.running -= 1
+            if group._slots:
+                group._slots.release()
+
+    def _done(self, group, task, coro, owner):
+        group.unfinished -= 1
+        group._room.set()
+        if owner is not None:
+            owned = self._owned.get(owner)
+            if owned:
+                owned.discard(task)
+                if not owned:
+                    del self._owned[owner]
+        if task.cancelled():
+            # Cancelled while queued, the coroutine never started
+            coro.close()
+            return
+        error = task.exception()
+        if error:
+            group.failed += 1
+            self._failures.labels(group.name).inc()
+            self.bot.errors.report(f"task {group.name}", error)
+
+    def cancel_owner(self, owner):
+        """Cancels the owner's running and queued tasks, e.g. in cog_unload."""
+        for task in self._owned.pop(owner, ()):
+            task.cancel()
+
+    def stats(self):
+        """Returns {group: (running, queued, failed, rejected)}."""
+        return {
+            name: (group.running, group.queued, group.failed, group.rejected)
+            for name, group in self.groups.items()
+        }